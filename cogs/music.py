@@ -6,11 +6,21 @@ import os
 
 import wavelink.player
 import settings
-from settings import load_playlists, save_playlists
-from utils.pagination import PaginationView, format_duration, create_green_embed, create_red_embed
+from utils.pagination import HistoryPageSource, PaginationView, QueuePageSource, create_green_embed, create_red_embed
+from utils.lanes import player_command
+from utils.metrics import metrics
+from utils.dispatch import dispatcher
+from utils.history import history
+from utils.autocomplete import choice, suggestions
+from utils.tracks import display_info, entry_to_track, search_tracks
+from utils.nodes import balancer, create_nodes
+from utils.player import MusicPlayer
+from utils.reaper import reaper
+from utils.sessions import load_snapshot, rebuild_players, resume_node_sessions, restore_sessions, save_snapshot
 
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
 import wavelink
 
 logger = settings.logging.getLogger(__name__)
@@ -21,28 +31,70 @@ class MusicBot(commands.Cog):
 
     def __init__(self, bot) -> None:
         self.bot = bot
-        self.loop_enabled = False
+        self.snapshot: dict = {}
 
     async def setup_hook(self) -> None:
-        nodes = [wavelink.Node(
-            uri = "http://localhost:2333",
-            password = "youshallnotpass"
-        )]
-        await wavelink.Pool.connect(
-            nodes = nodes,
-            client = self.bot,
-            cache_capacity = 100
-        )
+        # Nodes stay connected across reloads of this cog
+        if not wavelink.Pool.nodes:
+            self.snapshot = await asyncio.to_thread(load_snapshot)
+            nodes = create_nodes()
+            resume_node_sessions(nodes, self.snapshot)
+
+            # Search results are cached by utils.tracks.search_cache
+            await wavelink.Pool.connect(
+                nodes = nodes,
+                client = self.bot
+            )
+        self.check_nodes.start()
+        self.save_sessions.start()
+        self.reap_idle.start()
+
+    async def cog_unload(self) -> None:
+        self.check_nodes.cancel()
+        self.save_sessions.cancel()
+        self.reap_idle.cancel()
+        await save_snapshot(self.bot)
+
+    @tasks.loop(seconds = settings.LAVALINK_STATS_INTERVAL)
+    async def check_nodes(self) -> None:
+        """Refresh node load stats and move players off nodes that went down."""
+        await balancer.refresh()
+        await balancer.check_nodes()
+
+    @tasks.loop(seconds = settings.SESSION_SNAPSHOT_INTERVAL)
+    async def save_sessions(self) -> None:
+        """Snapshot every live player so it can be resumed after a restart."""
+        try:
+            await save_snapshot(self.bot)
+        except Exception as e:
+            logger.warning(f"Could not save the session snapshot: {e}")
+
+    @tasks.loop(seconds = settings.IDLE_CHECK_INTERVAL)
+    async def reap_idle(self) -> None:
+        """Disconnect players left alone, paused or without anything to play for too long."""
+        await reaper.sweep(list(self.bot.voice_clients))
 
     # ==================== Event Listeners ==================== #
 
     @commands.Cog.listener()
     async def on_wavelink_node_ready(self, payload: wavelink.NodeReadyEventPayload) -> None:
         logger.info(f"Wavelink node connected: {payload.node} | Resumed: {payload.resumed}")
+        await restore_sessions(self.bot, self.snapshot)
+
+    @commands.Cog.listener()
+    async def on_wavelink_node_closed(self, node: wavelink.Node, disconnected: list[wavelink.Player]) -> None:
+        logger.warning(f"Wavelink node closed: {node} | Players: {len(disconnected)}")
+        # The node already disconnected these players, they can't be switched over, only rebuilt
+        await rebuild_players(self.bot, disconnected)
+
+    @commands.Cog.listener()
+    async def on_wavelink_node_disconnected(self, payload: wavelink.NodeDisconnectedEventPayload) -> None:
+        # Move its players now instead of at the next node check
+        await balancer.check_nodes()
 
     @commands.Cog.listener()
     async def on_wavelink_track_start(self, payload: wavelink.TrackStartEventPayload) -> None:
-        player: wavelink.Player | None = payload.player
+        player = cast(MusicPlayer | None, payload.player)
         if not player:
             # This is handled in other functions
             return 
@@ -50,12 +102,13 @@ class MusicBot(commands.Cog):
         original: wavelink.Playable | None = payload.original
         track: wavelink.Playable = payload.track
 
+        info: dict = display_info(track)
         embed: discord.Embed = create_green_embed(
             title="Now Playing:", 
         )
-        embed.add_field(name=f"**{track.title}**", value=f"By **{track.author}**")
-        if track.artwork:
-            embed.set_image(url = track.artwork)
+        embed.add_field(name=f"**{info['title']}**", value=f"By **{info['author']}**")
+        if info["artwork"]:
+            embed.set_image(url = info["artwork"])
 
         if original and original.recommended:
             embed.description += f"\n\n'This track was recommended via {track.source}'"
@@ -63,100 +116,130 @@ class MusicBot(commands.Cog):
         if track.album.name:
             embed.add_field(name = "Album", value = track.album.name)
 
-        await player.home.send(embed = embed)
+        # Edits the channel's now playing message in place, merging rapid skips into one edit
+        dispatcher.notify(player.session.home, "now_playing", edit = True, embed = embed)
 
     @commands.Cog.listener()
     async def on_wavelink_track_end(self, payload: wavelink.TrackEndEventPayload) -> None:
-        player: wavelink.Player | None = payload.player
+        player = cast(MusicPlayer | None, payload.player)
         if not player:
             return
 
-        if self.loop_enabled:
-            track: wavelink.Playable = payload.track
+        track: wavelink.Playable = payload.track
+        session = player.session
+        if session.rewound and session.rewound == track.encoded:
+            # .previous already put it back at the front of the queue
+            session.rewound = None
+            return
+
+        if payload.reason != "loadFailed":
+            if session.history_session is None:
+                session.history_session = history.new_session(player.guild.id)
+            history.record(player.guild.id, track, session.history_session)
+        if session.loop:
             await player.queue.put_wait(track)
 
     # ==================== Player Commands ==================== #
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def join(self, ctx: commands.Context) -> None:
         """Join the user's current voice channel."""
         if not ctx.guild:
             return
         
-        player = cast(wavelink.Player, ctx.voice_client) 
+        player = cast(MusicPlayer, ctx.voice_client) 
         if not player:
             try:
-                player = await ctx.author.voice.channel.connect(cls = wavelink.Player)
+                player = await balancer.connect(ctx.author.voice.channel, MusicPlayer)
             except AttributeError:
                 embed: discord.Embed = create_red_embed(
                     description="Please join a voice channel first before using this command."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
                 return
             except discord.ClientException:
                 embed: discord.Embed = create_red_embed(
                     description="I was unable to join this voice channel. Please try again."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
+                return
+            except wavelink.InvalidNodeException:
+                embed: discord.Embed = create_red_embed(
+                    description="No music server is available right now. Please try again later."
+                )
+                await dispatcher.reply(ctx, embed=embed)
                 return
         elif player and ctx.author.voice.channel != player.channel:
             embed: discord.Embed = create_red_embed(
                 description=f"I can't join other channels while already playing in <#{player.channel.id}>."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def play(self, ctx: commands.Context, *, query: str) -> None:
         """Play a song with the given query."""
         await self.join(ctx)
-        player = cast(wavelink.Player, ctx.voice_client)  
+        player = cast(MusicPlayer, ctx.voice_client)  
 
         if player:  
             player.autoplay = wavelink.AutoPlayMode.partial
 
-            if not hasattr(player, "home"):
-                player.home = ctx.channel
+            if not player.session.home:
+                player.session.home = ctx.channel
             # The following code locks the bot to the initial text channel
-            # elif player.home != ctx.channel:
-            #     await ctx.send(f"You can only play songs in {player.home.mention}, as the Player has already started there")
+            # elif player.session.home != ctx.channel:
+            #     await ctx.send(f"You can only play songs in {player.session.home.mention}, as the Player has already started there")
             #     return
 
             # Look for spotify tracks first, otherwise use YouTube
-            if "open.spotify.com" in query:
-                tracks: wavelink.Search = await wavelink.Playable.search(query)
-            else:
-                tracks: wavelink.Search = await wavelink.Playable.search(query, source=wavelink.TrackSource.YouTube)
+            with metrics.span("search"):
+                tracks: wavelink.Search = await search_tracks(query)
         
             if not tracks:
                 embed: discord.Embed = create_red_embed(
                     description="I Could not find any tracks with that query."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
                 return
             
+            suggestions.remember(ctx.guild.id, query, None if isinstance(tracks, wavelink.Playlist) else tracks[0])
+
             if isinstance(tracks, wavelink.Playlist):
-                added: int = await player.queue.put_wait(tracks)
+                with metrics.span("put_wait"):
+                    added: int = await player.queue.put_wait(tracks)
                 embed: discord.Embed = create_green_embed(
                     description=f"Added the playlist **{tracks.name}** ({added} songs) to the queue."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
             else:
                 track: wavelink.Playable = tracks[0]
-                await player.queue.put_wait(track)
+                with metrics.span("put_wait"):
+                    await player.queue.put_wait(track)
                 embed: discord.Embed = create_green_embed(
                     description=f"Added **{track}** by **{track.author}** to the queue."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
 
             if not player.playing:
-                await player.play(player.queue.get(), volume = 15)
+                with metrics.span("player_play"):
+                    await player.play(player.queue.get(), volume = player.session.volume)
         else:
             return
         
-    @commands.command(aliases = ["next"])
+    @play.autocomplete("query")
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        # Answers from memory only, Discord drops autocomplete responses after 3 seconds
+        if not interaction.guild_id:
+            return []
+        return suggestions.suggest(interaction.guild_id, current)
+
+    @commands.hybrid_command(aliases = ["next"])
+    @player_command
     async def skip(self, ctx: commands.Context) -> None:
         """Skip the current song."""
-        player: wavelink.Player = cast(wavelink.Player, ctx.voice_client)
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
         if not player:
             return
         
@@ -164,12 +247,50 @@ class MusicBot(commands.Cog):
         embed: discord.Embed = create_green_embed(
             description="Skipped the current track."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command(aliases = ["back"])
+    @player_command
+    async def previous(self, ctx: commands.Context) -> None:
+        """Play the previous song again."""
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
+        if not player:
+            return
+
+        entry = history.previous(ctx.guild.id)
+        if not entry:
+            embed: discord.Embed = create_red_embed(
+                description="There are no previous songs."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+            return
+
+        interrupted = player.current
+        if interrupted:
+            player.session.rewound = interrupted.encoded
+
+        track: wavelink.Playable = entry_to_track(entry)
+        try:
+            with metrics.span("player_play"):
+                await player.play(track)
+        except Exception:
+            player.session.rewound = None
+            raise
+
+        # The interrupted song plays again next
+        if interrupted:
+            player.queue.put_at(0, interrupted)
+        info: dict = display_info(track)
+        embed: discord.Embed = create_green_embed(
+            description=f"Playing **{info['title']}** by **{info['author']}** again."
+        )
+        await dispatcher.reply(ctx, embed=embed)
+
+    @commands.hybrid_command()
+    @player_command
     async def pause(self, ctx: commands.Context) -> None:
         """Pause the Player."""
-        player: wavelink.Player = cast(wavelink.Player, ctx.voice_client)
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
         if not player:
             return
 
@@ -177,12 +298,13 @@ class MusicBot(commands.Cog):
         embed: discord.Embed = create_green_embed(
             description="Paused the Player."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def resume(self, ctx: commands.Context) -> None:
         """Resume the Player."""
-        player: wavelink.Player = cast(wavelink.Player, ctx.voice_client)
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
         if not player:
             return
 
@@ -190,174 +312,241 @@ class MusicBot(commands.Cog):
         embed: discord.Embed = create_green_embed(
             description="Resumed the Player."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def stop(self, ctx: commands.Context) -> None:
         """Stop the Player."""
-        player: wavelink.Player = cast(wavelink.Player, ctx.voice_client)
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
         if not player:
             return
 
-        await self.clear(ctx)
+        player.cancel_loaders()
+        player.queue.clear()
         await player.stop()
-        self.loop_enabled = False
+        player.session.loop = False
         embed: discord.Embed = create_green_embed(
             description="Stopped the Player."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def leave(self, ctx: commands.Context) -> None:
         """Disconnect the Player."""
-        player: wavelink.Player = cast(wavelink.Player, ctx.voice_client)
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
         if not player:
             return
         
+        dispatcher.forget(player.session.home, "now_playing")
         await player.disconnect()
         embed: discord.Embed = create_green_embed(
             description="Bye! :wave:"
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
     # ==================== Queue Commands ==================== #
     
-    @commands.command()
+    @commands.hybrid_command()
     async def queue(self, ctx: commands.Context) -> None:
         """Displays the song queue"""
-        player = cast(wavelink.Player, ctx.voice_client)
+        player = cast(MusicPlayer, ctx.voice_client)
         
         if not player or not player.queue and not player.playing:
             embed: discord.Embed = create_red_embed(
                 description="There are no songs in the queue."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
         
-        titles = []
-        descriptions = []
-        if player.playing:
-            titles.append(f"Now Playing: {player.current.title}")
-            descriptions.append(f"By {player.current.author} | Duration: {format_duration(player.current.length)}")
-
-        for track in player.queue:
-            titles.append(f"{track.title}")
-            descriptions.append(f"By {track.author} | Duration: {format_duration(track.length)}")
-        
-        pagination_view = PaginationView(playlist_title="Current Queue", titles=titles, descriptions=descriptions)
+        # Pages are rendered on demand from the live queue
+        pagination_view = PaginationView(QueuePageSource(player))
+        await pagination_view.send(ctx)
+
+    @commands.hybrid_command()
+    @commands.guild_only()
+    async def history(self, ctx: commands.Context) -> None:
+        """Displays the recently played songs"""
+        if not history.ring(ctx.guild.id):
+            embed: discord.Embed = create_red_embed(
+                description="No songs have been played yet."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+            return
+
+        pagination_view = PaginationView(HistoryPageSource(ctx.guild.id))
         await pagination_view.send(ctx)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
+    async def replay(self, ctx: commands.Context) -> None:
+        """Queue the songs of the last listening session again"""
+        await self.join(ctx)
+        player = cast(MusicPlayer, ctx.voice_client)
+        if not player:
+            return
+
+        # Tracks are rebuilt from their encoded data, without searching again
+        entries = history.last_session(ctx.guild.id, exclude = player.session.history_session)
+        if not entries:
+            embed: discord.Embed = create_red_embed(
+                description="There is no previous session to replay."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+            return
+
+        player.autoplay = wavelink.AutoPlayMode.partial
+        if not player.session.home:
+            player.session.home = ctx.channel
+
+        with metrics.span("put_wait"):
+            added: int = await player.queue.put_wait([entry_to_track(entry) for entry in entries])
+        embed: discord.Embed = create_green_embed(
+            description=f"Added the last session ({added} songs) to the queue."
+        )
+        await dispatcher.reply(ctx, embed=embed)
+
+        if not player.playing:
+            with metrics.span("player_play"):
+                await player.play(player.queue.get(), volume = player.session.volume)
+
+    @commands.hybrid_command()
+    @player_command
     async def loop(self, ctx: commands.Context) -> None:
         """Toggles Loop on the current queue"""
-        self.loop_enabled = not self.loop_enabled
-        status = "enabled" if self.loop_enabled else "disabled"
+        player = cast(MusicPlayer, ctx.voice_client)
+        if not player:
+            embed: discord.Embed = create_red_embed(
+                description="I'm not connected to a voice channel."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+            return
+
+        player.session.loop = not player.session.loop
+        status = "enabled" if player.session.loop else "disabled"
         embed: discord.Embed = create_green_embed(
             description=f"Looping has been {status}"
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def shuffle(self, ctx: commands.Context) -> None:
-        player = cast(wavelink.Player, ctx.voice_client)
+        """Shuffle the queue."""
+        player = cast(MusicPlayer, ctx.voice_client)
 
         if not player or not player.queue:
             embed: discord.Embed = create_red_embed(
                 description="The queue is empty."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
         
         player.queue.shuffle()
         embed: discord.Embed = create_green_embed(
             description="The queue has been shuffled."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def jump(self, ctx: commands.Context, *, query: str) ->None:
-        """Jump to a song in the queue and play it"""
-        player = cast(wavelink.Player, ctx.voice_client)
+        """Jump to a song in the queue, by title or position, and play it"""
+        player = cast(MusicPlayer, ctx.voice_client)
 
         if not player or not player.queue:
             embed: discord.Embed = create_red_embed(
                 description="The queue is empty."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
         
-        found_track = None
-        for i, track in enumerate(player.queue):
-            if query.lower() in track.title.lower():
-                found_track = track
-                player.queue.delete(i)
-                break
-        
-        if found_track == None:
+        # Matches by exact title, position number, title substring or closest title/author
+        match = player.queue.find(query)
+        if match == None:
             embed: discord.Embed = create_red_embed(
                 description=f"No track found that matches the query: **{query}**."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
-        
+
+        i, found_track = match
+        player.queue.delete(i)
         embed: discord.Embed = create_green_embed(
             description=f"Jumped to **{found_track.title}** by **{found_track.author}**."
         )
-        await ctx.send(embed=embed)
-        await player.play(found_track)
+        await dispatcher.reply(ctx, embed=embed)
+        with metrics.span("player_play"):
+            await player.play(found_track)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def clear(self, ctx: commands.Context) -> None:
         """Clears the queue"""
-        player = cast(wavelink.Player, ctx.voice_client)
+        player = cast(MusicPlayer, ctx.voice_client)
 
         if not player or not player.queue:
             embed: discord.Embed = create_red_embed(
                 description=f"The queue is already empty."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
         
         player.queue.clear()
         embed: discord.Embed = create_green_embed(
             description="The queue has been cleared."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
 
-    @commands.command()
+    @commands.hybrid_command()
+    @player_command
     async def remove(self, ctx: commands.Context, *, query: str) -> None:
-        """Removes the specified song from the queue"""
-        player: wavelink.Player = cast(wavelink.Player, ctx.voice_client)
+        """Removes the specified song, by title or position, from the queue"""
+        player: MusicPlayer = cast(MusicPlayer, ctx.voice_client)
 
         if not player or not player.queue:
             embed: discord.Embed = create_red_embed(
             title="The queue is already empty."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
         
-        found_track = None
-        for i, track in enumerate(player.queue):
-            if query.lower() in track.title.lower():
-                found_track = track
-                player.queue.delete(i)
-                break
-        
-        if found_track == None:
+        # Matches by exact title, position number, title substring or closest title/author
+        match = player.queue.find(query)
+        if match == None:
             embed: discord.Embed = create_red_embed(
                 title=f"No track found that matches the query: **{query}**"
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             return
 
+        i, found_track = match
+        player.queue.delete(i)
         embed: discord.Embed = create_green_embed(
             title=f"Removed {found_track.title} by {found_track.author} from the queue."
         )
-        await ctx.send(embed=embed)
+        await dispatcher.reply(ctx, embed=embed)
+
+    @jump.autocomplete("query")
+    @remove.autocomplete("query")
+    async def queue_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        """Queued tracks matching the text, from the queue's title index."""
+        player = cast(MusicPlayer | None, interaction.guild.voice_client if interaction.guild else None)
+        if not player or not player.queue:
+            return []
+
+        if current:
+            matches = player.queue.matches(current, limit = 25)
+        else:
+            matches = list(enumerate(player.queue[:25]))
+        # By position, so picking one of several songs with the same title gets that one
+        choices = [choice(f"{i + 1}. {track.title} - {track.author}", f"#{i + 1}") for i, track in matches]
+        return [item for item in choices if item]
 
     # ==================== Miscellaneous Commands ==================== #
 
-    @commands.command()
+    @commands.hybrid_command()
     async def helldive(self, ctx: commands.Context) -> None:
         """Plays Fortunate Son by Creedence Clearwater Revival"""
         await self.play(ctx, query = "https://www.youtube.com/watch?v=ZWijx_AgPiA")
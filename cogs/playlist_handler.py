@@ -1,213 +1,327 @@
 import asyncio
 import logging
+import time
 from typing import cast
 import json
 import os
 
 import wavelink.player
 import settings
-from settings import load_playlists, save_playlists
-from utils.pagination import PaginationView, ConfirmationView
+from utils.dispatch import dispatcher
+from utils.autocomplete import choice, playlist_choices, suggestions
+from utils.pagination import PaginationView, PlaylistPageSource, ConfirmationView
 from utils.pagination import format_duration, create_green_embed, create_red_embed
+from utils.tracks import search_tracks, track_to_entry
+from utils.loader import PlaylistLoader
+from utils.lanes import player_command
+from utils.metrics import metrics
+from utils.imports import ImportJob, entry_keys
+from utils.playlists import PlaylistRepository, entry_author
+from utils.nodes import balancer
+from utils.player import MusicPlayer
 
 import discord
+from discord import app_commands
 from discord.ext import commands
 import wavelink
 
 logger = settings.logging.getLogger(__name__)
-playlists = load_playlists()
 
 class PlaylistHandler(commands.Cog):
 
     def __init__(self, bot) -> None:
         self.bot = bot
+        # Owned by the bot so reloading this cog keeps the loaded playlists
+        self.playlists: PlaylistRepository = bot.playlists
 
+    async def cog_unload(self) -> None:
+        await self.playlists.flush()
+
+    @player_command
     async def join(self, ctx: commands.Context) -> None:
         """Join the user's current voice channel."""
         if not ctx.guild:
             return
         
-        player = cast(wavelink.Player, ctx.voice_client) 
+        player = cast(MusicPlayer, ctx.voice_client) 
 
         if not player:
             try:
-                player = await ctx.author.voice.channel.connect(cls = wavelink.Player)
+                player = await balancer.connect(ctx.author.voice.channel, MusicPlayer)
             except AttributeError:
                 embed: discord.Embed = create_red_embed(
                     description="Please join a voice channel first before using this command."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
                 return
             except discord.ClientException:
                 embed: discord.Embed = create_red_embed(
                     description="I was unable to join this voice channel. Please try again."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
+                return
+            except wavelink.InvalidNodeException:
+                embed: discord.Embed = create_red_embed(
+                    description="No music server is available right now. Please try again later."
+                )
+                await dispatcher.reply(ctx, embed=embed)
                 return
         elif player and ctx.author.voice.channel != player.channel:
             embed: discord.Embed = create_red_embed(
                 description=f"I can't join other channels while already playing in <#{player.channel.id}>."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
 
     # ==================== Playlists Commands ==================== #
 
-    @commands.group()
+    @commands.hybrid_group()
     async def playlist(self, ctx: commands.Context):
+        """Save, play and manage this server's playlists."""
         if ctx.invoked_subcommand is None:
             embed: discord.Embed = create_red_embed(
                 description="Use **.playlist help** for informations on available playlist commands."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
 
     @playlist.command()
+    @player_command
     async def add(self, ctx: commands.Context, name: str, *, query: str):
         """Add a song to a specific playlist."""
-        guild_id = str(ctx.guild.id)
+        with metrics.span("search"):
+            tracks: wavelink.Search = await search_tracks(query)
 
-        # Create a new playlist if it doesn't exist
-        if guild_id not in playlists:
-            playlists[guild_id] = {}
-
-        # Add the song to the playlist
-        if name not in playlists[guild_id]:
-            playlists[guild_id][name] = []
-        
-        if "open.spotify.com" in query:
-            tracks: wavelink.Search = await wavelink.Playable.search(query)
-        else:
-            tracks: wavelink.Search = await wavelink.Playable.search(query, source=wavelink.TrackSource.YouTube)
+        if not tracks:
+            embed: discord.Embed = create_red_embed(
+                description="I Could not find any tracks with that query."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+            return
 
+        # The playlist is created if it doesn't exist
         if isinstance(tracks, wavelink.Playlist):
-            for track in tracks:
-                playlists[guild_id][name].append({
-                    "title": track.title,
-                    "description": f"By {track.author} | Duration: {format_duration(track.length)}",
-                    "url": track.uri
-                })
-            embed: discord.Embed = create_green_embed(
-                description=f"Added playlist **{tracks.name}** ({len(tracks)} songs) to the playlist **{name}**."
-            )
-            await ctx.send(embed=embed)
+            # Imported in the background, with a progress message in this channel
+            job = ImportJob(ctx.guild.id, ctx.channel.id, name, query, source=tracks.name)
+            self.bot.imports.start(job, ctx.channel, tracks.tracks)
         else:
             track: wavelink.Playable = tracks[0]
-            playlists[guild_id][name].append({
-                "title": track.title,
-                "description": f"By {track.author} | Duration: {format_duration(track.length)}",
-                "url": track.uri
-            })
+            entry: dict = track_to_entry(track)
+            playlist_songs = await self.playlists.get(ctx.guild.id, name) or []
+
+            if any(entry_keys(entry) & entry_keys(song) for song in playlist_songs):
+                embed: discord.Embed = create_red_embed(
+                    description=f"**{track.title}** is already in the playlist **{name}**."
+                )
+                await dispatcher.reply(ctx, embed=embed)
+                return
+
+            if await self.playlists.size(ctx.guild.id) >= settings.PLAYLIST_GUILD_LIMIT:
+                embed: discord.Embed = create_red_embed(
+                    description=f"This server has reached the limit of {settings.PLAYLIST_GUILD_LIMIT} saved songs."
+                )
+                await dispatcher.reply(ctx, embed=embed)
+                return
+
+            await self.playlists.add(ctx.guild.id, name, [entry])
+            suggestions.remember(ctx.guild.id, query, track)
             embed: discord.Embed = create_green_embed(
                 description=f"Added **{track.title}** by **{track.author}** to the playlist **{name}**."
             )
-            await ctx.send(embed=embed)
-
-        # Save the updated playlists
-        settings.save_playlists(playlists)
+            await dispatcher.reply(ctx, embed=embed)
 
     @playlist.command()
+    @player_command
     async def play(self, ctx: commands.Context, name: str):
         """Play a specific playlist."""
-        guild_id = str(ctx.guild.id)
+        playlist_songs = await self.playlists.get(ctx.guild.id, name)
 
-        if guild_id in playlists and name in playlists[guild_id]:
+        if playlist_songs is not None:
             await self.join(ctx)
-            player = cast(wavelink.Player, ctx.voice_client)
+            player = cast(MusicPlayer, ctx.voice_client)
 
             if player:
                 player.autoplay = wavelink.AutoPlayMode.partial
 
-                if not hasattr(player, "home"):
-                    player.home = ctx.channel
+                if not player.session.home:
+                    player.session.home = ctx.channel
 
-                for track_data in playlists[guild_id][name]:
-                    query = track_data["url"]
-                    if "open.spotify.com" in query:
-                        tracks: wavelink.Search = await wavelink.Playable.search(query)
-                    else:
-                        tracks: wavelink.Search = await wavelink.Playable.search(query, source=wavelink.TrackSource.YouTube)
+                # Start playing as soon as the first track is ready and load the rest in the background
+                loader = PlaylistLoader(player, self.playlists, ctx.guild.id, name, playlist_songs)
+                track = await loader.resolve_first()
+                if not track:
+                    embed: discord.Embed = create_red_embed(
+                        description=f"None of the songs in playlist **{name}** could be found."
+                    )
+                    await dispatcher.reply(ctx, embed=embed)
+                    return
 
-                    track: wavelink.Playable = tracks[0]
+                with metrics.span("put_wait"):
                     await player.queue.put_wait(track)
-
                 embed: discord.Embed = create_green_embed(
                     description=f"Playing playlist **{name}**."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
                 if not player.playing:
-                    await player.play(player.queue.get(), volume = 15)
+                    with metrics.span("player_play"):
+                        await player.play(player.queue.get(), volume = player.session.volume)
+
+                loader.start()
         else:
             embed: discord.Embed = create_red_embed(
                 description=f"Playlist **{name}** not found."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
 
     @playlist.command()
     async def list(self, ctx: commands.Context, name: str) -> None:
         """List songs from a specific playlist"""
-        guild_id = str(ctx.guild.id)    
+        playlist_songs = await self.playlists.get(ctx.guild.id, name)
 
-        if guild_id in playlists and name in playlists[guild_id]:
-            playlist_songs = playlists[guild_id][name]
+        if playlist_songs is not None:
             if playlist_songs:
-                titles = [song["title"] for song in playlist_songs]
-                descriptions = [song["description"] for song in playlist_songs]
-                view = PaginationView(playlist_title=name, titles=titles, descriptions=descriptions)
+                view = PaginationView(PlaylistPageSource(self.playlists, ctx.guild.id, name, playlist_songs))
                 await view.send(ctx)
             else:
                 embed: discord.Embed = create_red_embed(
                     description=f"Playlist **{name}** is empty."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
         else:
             embed: discord.Embed = create_red_embed(
                 description=f"Playlist **{name}** not found."
             )
-            await ctx.send(embed=embed)
+            await dispatcher.reply(ctx, embed=embed)
             
     @playlist.command()
     async def remove(self, ctx: commands.Context, name: str, *, song_name: str = None) -> None:
         """Remove a song from a specific playlist."""
-        guild_id = str(ctx.guild.id)
+        playlist_songs = await self.playlists.get(ctx.guild.id, name)
 
-        if guild_id in playlists and name in playlists[guild_id]:
+        if playlist_songs is not None:
             
             # The following code is to remove the entire playlist
             if song_name is None:
-                view = ConfirmationView(ctx, name, playlists)
+                view = ConfirmationView(ctx, name, self.playlists)
                 await view.send(ctx)
                 return
             
             # The following code is to remove a secific song
-            playlist_songs = playlists[guild_id][name]
             if playlist_songs:
 
-                found_track = None
-                for i, track in enumerate(playlist_songs):
-                    if song_name.lower() in track["title"].lower():
-                        found_track = track
-                        playlist_songs.pop(i)
-                        settings.save_playlists(playlists)
-                        embed: discord.Embed = create_green_embed(
-                            description=f"Removed {found_track['title']} from playlist {name}."
-                        )
-                        await ctx.send(embed=embed) 
-
-                if found_track == None:
+                # By exact title, then position ("#3" is always a position), then the one song whose title contains it
+                position = song_name.removeprefix("#")
+                matches = [] if song_name.startswith("#") else await self.playlists.find(ctx.guild.id, song_name, name = name, fuzzy = False)
+                exact = [match for match in matches if match[2]["title"].lower() == song_name.lower()]
+                if exact:
+                    matches = exact
+                elif position.isdigit() and 1 <= int(position) <= len(playlist_songs):
+                    matches = [(name, int(position) - 1, playlist_songs[int(position) - 1])]
+
+                if not matches:
                     embed: discord.Embed = create_red_embed(
                         description=f"Track {song_name} not found in playlist {name}."
                     )
-                    await ctx.send(embed=embed)
+                elif len({id(entry) for _, _, entry in matches}) > 1:
+                    # Never guess which one was meant
+                    lines = [f"{i + 1}. {entry['title']}" for _, i, entry in matches[:5]]
+                    embed: discord.Embed = create_red_embed(
+                        description=f"{len(matches)} songs in playlist {name} match **{song_name}**:\n" + "\n".join(lines)
+                            + "\n\nUse the song's number (e.g. #3) or its full title to remove it."
+                    )
+                else:
+                    _, i, found_track = matches[0]
+                    await self.playlists.remove(ctx.guild.id, name, i)
+                    embed: discord.Embed = create_green_embed(
+                        description=f"Removed {found_track['title']} from playlist {name}."
+                    )
+                await dispatcher.reply(ctx, embed=embed)
             else:
                 embed: discord.Embed = create_red_embed(
                     description=f"Playlist {name} is empty."
                 )
-                await ctx.send(embed=embed)
+                await dispatcher.reply(ctx, embed=embed)
         else:
             embed: discord.Embed = create_red_embed(
                 description=f"Playlist {name} not found."
             )
-            await ctx.send(embed=embed)   
+            await dispatcher.reply(ctx, embed=embed)   
+
+    @playlist.command()
+    async def find(self, ctx: commands.Context, *, query: str) -> None:
+        """Search songs by title or artist across this server's playlists."""
+        start = time.perf_counter()
+        matches = await self.playlists.find(ctx.guild.id, query)
+        elapsed = time.perf_counter() - start
+
+        if not matches:
+            embed: discord.Embed = create_red_embed(
+                description=f"No saved song matches **{query}**."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+            return
+
+        lines = [
+            f"**{entry['title']}**{f' by {entry_author(entry)}' if entry_author(entry) else ''} - **{name}** #{i + 1}"
+            for name, i, entry in matches[:10]
+        ]
+        if len(matches) > 10:
+            lines.append(f"... and {len(matches) - 10} more")
+        embed: discord.Embed = create_green_embed(
+            title=f"Songs matching {query}",
+            description="\n".join(lines)
+        )
+        embed.set_footer(text=f"{len(matches)} matches in {elapsed * 1000:.2f} ms")
+        await dispatcher.reply(ctx, embed=embed)
+
+    @playlist.command()
+    async def rename(self, ctx: commands.Context, name: str, new_name: str) -> None:
+        """Rename a specific playlist."""
+        if await self.playlists.get(ctx.guild.id, name) is None:
+            embed: discord.Embed = create_red_embed(
+                description=f"Playlist **{name}** not found."
+            )
+        elif not await self.playlists.rename(ctx.guild.id, name, new_name):
+            embed: discord.Embed = create_red_embed(
+                description=f"A playlist named **{new_name}** already exists."
+            )
+        else:
+            embed: discord.Embed = create_green_embed(
+                description=f"Renamed playlist **{name}** to **{new_name}**."
+            )
+        await dispatcher.reply(ctx, embed=embed)
         
+    # ==================== Autocomplete ==================== #
+
+    @add.autocomplete("name")
+    @play.autocomplete("name")
+    @list.autocomplete("name")
+    @remove.autocomplete("name")
+    @rename.autocomplete("name")
+    # The return annotations are strings, as `list` is the list command inside this class
+    async def name_autocomplete(self, interaction: discord.Interaction, current: str) -> "list[app_commands.Choice[str]]":
+        # Names come from the in-memory repository, loaded from the store only on a guild's first use
+        if not interaction.guild_id:
+            return []
+        return playlist_choices(await self.playlists.names(interaction.guild_id), current)
+
+    @remove.autocomplete("song_name")
+    async def song_autocomplete(self, interaction: discord.Interaction, current: str) -> "list[app_commands.Choice[str]]":
+        """Songs of the playlist chosen in the name option, from the guild's playlist index."""
+        name = interaction.namespace.name
+        if not interaction.guild_id or not name or not current:
+            return []
+        matches = await self.playlists.find(interaction.guild_id, current, name = name)
+        # By position, so picking one of several songs with the same title removes that one
+        choices = [choice(f"{i + 1}. {entry['title']}", f"#{i + 1}") for _, i, entry in matches[:25]]
+        return [item for item in choices if item]
+
+    @add.autocomplete("query")
+    async def query_autocomplete(self, interaction: discord.Interaction, current: str) -> "list[app_commands.Choice[str]]":
+        if not interaction.guild_id:
+            return []
+        return suggestions.suggest(interaction.guild_id, current)
+
 async def setup(bot):
     playlist_handler = PlaylistHandler(bot)
-    await bot.add_cog(playlist_handler)
\ No newline at end of file
+    await bot.add_cog(playlist_handler)
+    # Imports that were running when the bot stopped
+    await bot.imports.resume(bot)
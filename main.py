@@ -1,22 +1,186 @@
+import hashlib
+import json
+import os
+import sys
+import time
+
 import settings
 import discord
+import wavelink
 from discord.ext import commands
 from utils.pagination import create_green_embed, create_red_embed
+from utils.autocomplete import prefix_cache
+from utils.circuit import LavalinkUnavailable, lavalink
+from utils.dispatch import dispatcher
+from utils.history import history
+from utils.imports import PlaylistImporter
+from utils.lanes import lanes
+from utils.logs import log_pipeline
+from utils.metrics import metrics, start_metrics_server
+from utils.playlists import PlaylistRepository
+from utils.reaper import reaper
+from utils.storage import create_playlist_store
+from utils.tracks import search_cache
 
 logger = settings.logging.getLogger("bot")
 
+def memory_usage() -> int | None:
+    """Resident memory of this process in bytes, if the platform reports it."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current usage; reported in bytes on macOS and in kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def create_intents() -> discord.Intents:
+    """Only the gateway events the music features use."""
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.message_content = settings.PREFIX_COMMANDS
+    return intents
+
+def create_member_cache_flags() -> discord.MemberCacheFlags:
+    # Members in voice channels are enough for ctx.author.voice and checking who is listening
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    return member_cache_flags
+
+class BotContext(commands.Context):
+    """Context remembering whether the command replied, so a deferred slash command is never left thinking."""
+    replied: bool = False
+
+    async def send(self, *args, **kwargs) -> discord.Message:
+        message = await super().send(*args, **kwargs)
+        self.replied = True
+        return message
+
+class Bot(commands.AutoShardedBot):
+    """Bot owning the state shared by the cogs, so it survives cog reloads."""
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.playlists = PlaylistRepository(create_playlist_store())
+        self.imports = PlaylistImporter(self.playlists)
+        self.metrics_server = None
+
+        metrics.register_gauges("gateway", lambda: {
+            "latency_seconds": self.latency,
+            "guilds": len(self.guilds),
+            "players": len(self.voice_clients)
+        })
+        metrics.register_gauges("dispatch", dispatcher.stats)
+        metrics.register_gauges("search_cache", search_cache.stats)
+        metrics.register_gauges("autocomplete_cache", prefix_cache.stats)
+        metrics.register_gauges("lanes", lanes.stats)
+        metrics.register_gauges("lavalink", lavalink.stats)
+        metrics.register_gauges("logging", log_pipeline.stats)
+        metrics.register_gauges("history", history.stats)
+        metrics.register_gauges("reaper", reaper.stats)
+
+    async def get_context(self, origin, /, *, cls = BotContext):
+        # Slash commands get their context from here too
+        return await super().get_context(origin, cls = cls)
+
+    async def sync_commands(self, force: bool = False) -> bool:
+        """Sync the slash commands to GUILDS_ID if they changed since the last sync. Returns whether it synced."""
+        self.tree.copy_global_to(guild = settings.GUILDS_ID)
+        payload = [command.to_dict(self.tree) for command in self.tree.get_commands(guild = settings.GUILDS_ID)]
+        digest = hashlib.sha256(json.dumps(payload, sort_keys = True).encode()).hexdigest()
+
+        try:
+            synced = settings.COMMAND_TREE_PATH.read_text().strip()
+        except OSError:
+            synced = None
+        if digest == synced and not force:
+            return False
+
+        await self.tree.sync(guild = settings.GUILDS_ID)
+        settings.write_atomic(settings.COMMAND_TREE_PATH, digest)
+        logger.info(f"Synced {len(payload)} slash commands to guild {settings.GUILDS_ID.id}")
+        return True
+
+    async def setup_hook(self) -> None:
+        if settings.METRICS_PORT:
+            self.metrics_server = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
+            logger.info(f"Serving metrics on http://{settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics")
+
+    async def close(self) -> None:
+        # Cogs are unloaded first, then running imports are stopped and pending playlist changes are written
+        await super().close()
+        await self.imports.close()
+        await self.playlists.close()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+
+    def memory_report(self) -> str:
+        guilds = len(self.guilds)
+        members = sum(len(guild.members) for guild in self.guilds)
+        voice = sum(len(channel.voice_states) for guild in self.guilds for channel in guild.voice_channels)
+        rss = memory_usage()
+
+        report = f"Shards: {self.shard_count} {sorted(self.shards)} | Guilds: {guilds} | Cached members: {members} | Users in voice: {voice} | Players: {len(self.voice_clients)}"
+        if rss is not None:
+            report += f" | RSS: {rss / 2**20:.1f} MiB"
+            if guilds:
+                report += f" ({rss / guilds / 2**10:.1f} KiB per guild)"
+        return report
+
 def run():
-    intents = discord.Intents.all()
-    bot = commands.Bot(command_prefix=".", intents=intents)
+    bot = Bot(
+        command_prefix="." if settings.PREFIX_COMMANDS else commands.when_mentioned,
+        intents=create_intents(),
+        member_cache_flags=create_member_cache_flags(),
+        chunk_guilds_at_startup=False,
+        shard_count=settings.SHARD_COUNT,
+        shard_ids=settings.SHARD_IDS
+    )
 
     @bot.event
     async def on_ready():
         logger.info(f"User: {bot.user} (ID: {bot.user.id})")
-        await bot.load_extension("cogs.music")
-        await bot.load_extension("cogs.playlist_handler")
+        logger.info(bot.memory_report())
+        # on_ready fires again after shards reconnect
+        for extension in ("cogs.music", "cogs.playlist_handler"):
+            if extension not in bot.extensions:
+                await bot.load_extension(extension)
+        await bot.sync_commands()
+
+    @bot.before_invoke
+    async def start_command(ctx: BotContext):
+        ctx.started = time.perf_counter()
+        # From the message being sent to the command starting: gateway delivery, parsing and checks
+        metrics.observe("stage", "gateway", max(0.0, (discord.utils.utcnow() - ctx.message.created_at).total_seconds()))
+        # Slash commands must be answered within 3 seconds, searches and joins can take longer
+        if ctx.interaction:
+            await ctx.defer()
+
+    @bot.after_invoke
+    async def finish_command(ctx: BotContext):
+        metrics.observe("command", ctx.command.qualified_name, time.perf_counter() - ctx.started)
+        # Commands with nothing to say would leave the deferred slash command thinking
+        if ctx.interaction and not ctx.replied:
+            try:
+                await ctx.interaction.delete_original_response()
+            except discord.HTTPException:
+                pass
 
     @bot.event
     async def on_command_error(ctx: commands.Context, error: commands.CommandError):
+        # Prefix commands wrap what they raised in CommandInvokeError, slash commands in two layers
+        original = error
+        while isinstance(original, (commands.CommandInvokeError, commands.HybridCommandError, discord.app_commands.CommandInvokeError)):
+            original = original.original
+
         if isinstance(error, commands.CommandNotFound):
             embed: discord.Embed = create_red_embed(
                 description=f"Command **{ctx.invoked_with}** not found. Use **.help** for informations on available commands."
@@ -27,6 +191,22 @@ def run():
                 description="You do not have permission to use this command."
             )
             await ctx.send(embed=embed)
+        elif isinstance(error, commands.NoPrivateMessage):
+            embed: discord.Embed = create_red_embed(
+                description="This command can only be used in a server."
+            )
+            await ctx.send(embed=embed)
+        elif isinstance(original, LavalinkUnavailable):
+            # Lavalink kept failing or its circuit is open, the message says when to try again
+            embed: discord.Embed = create_red_embed(
+                description=str(original)
+            )
+            await ctx.send(embed=embed)
+        elif isinstance(original, wavelink.LavalinkLoadException):
+            embed: discord.Embed = create_red_embed(
+                description=f"I could not load that track: {original.error}"
+            )
+            await ctx.send(embed=embed)
         else:
             raise error
 
@@ -45,7 +225,34 @@ def run():
     async def reload(ctx: commands.Context, cog: str):
         await bot.reload_extension(f"cogs.{cog.lower()}")
 
-    bot.run(settings.DISCORD_API_TOKEN, root_logger=True)
+    @bot.command(hidden=True)
+    @commands.is_owner()
+    async def sync(ctx: commands.Context):
+        """Sync the slash commands now, e.g. after reloading a cog that changed them."""
+        await bot.sync_commands(force=True)
+        embed: discord.Embed = create_green_embed(
+            description=f"Synced the slash commands to guild {settings.GUILDS_ID.id}."
+        )
+        await ctx.send(embed=embed)
+
+    @bot.command(hidden=True)
+    @commands.is_owner()
+    async def stats(ctx: commands.Context):
+        embed: discord.Embed = create_green_embed(title="Latency (ms)")
+        for kind, title in (("command", "Commands"), ("stage", "Stages")):
+            rows = metrics.summary(kind)[:15]
+            if rows:
+                table = [f"{'':<16}{'n':>6}{'p50':>8}{'p95':>8}{'p99':>8}"]
+                table += [f"{name[:16]:<16}{count:>6}{p50:>8.1f}{p95:>8.1f}{p99:>8.1f}" for name, count, p50, p95, p99 in rows]
+                embed.add_field(name=title, value="```\n" + "\n".join(table) + "\n```", inline=False)
+
+        for name, values in metrics.read_gauges().items():
+            value = "\n".join(f"{key}: {round(value, 3) if isinstance(value, float) else value}" for key, value in values.items())
+            embed.add_field(name=name, value=value or "-")
+        await ctx.send(embed=embed)
+
+    # Logging is configured by settings, discord.py must not add its own handler
+    bot.run(settings.DISCORD_API_TOKEN, log_handler=None)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -5,6 +5,8 @@ from logging.config import dictConfig
 from dotenv import load_dotenv
 import discord
 import json
+from utils.metrics import metrics
+from utils.logs import log_pipeline
 
 load_dotenv()
 
@@ -16,32 +18,186 @@ CMDS_DIR = BASE_DIR / "cmds"
 COGS_DIR = BASE_DIR / "cogs"
 
 GUILDS_ID = discord.Object(id=int(os.getenv("GUILD")))
+# Slash commands are synced to GUILDS_ID, which is instant, and only when they changed since the last sync
+COMMAND_TREE_PATH = BASE_DIR / "command_tree.sha256"
+# Whether "." prefix commands are read from messages, which needs the privileged message content intent.
+# Without them the bot only answers slash commands and mentions
+PREFIX_COMMANDS = os.getenv("PREFIX_COMMANDS", "true").lower() == "true"
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 
+# Shards run by this process. SHARD_COUNT unset lets Discord pick the count; set both to
+# split the shards across processes, e.g. SHARD_COUNT=4 with SHARD_IDS=0,1 and SHARD_IDS=2,3
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+
 PLAYLISTS_PATH = BASE_DIR / "playlists.json"
+# Maximum number of concurrent searches when loading playlist entries saved without encoded tracks
+PLAYLIST_SEARCH_CONCURRENCY = int(os.getenv("PLAYLIST_SEARCH_CONCURRENCY", 4))
+
+# Lavalink nodes as a JSON list of {"identifier": ..., "uri": ..., "password": ...}
+LAVALINK_NODES = json.loads(os.getenv(
+    "LAVALINK_NODES",
+    '[{"identifier": "local", "uri": "http://localhost:2333", "password": "youshallnotpass"}]'
+))
+# Seconds between node load checks, and how long a node keeps our players after a websocket drop
+LAVALINK_STATS_INTERVAL = float(os.getenv("LAVALINK_STATS_INTERVAL", 30))
+# Load checks a node must fail in a row before its players are moved to another node
+LAVALINK_UNREACHABLE_AFTER = int(os.getenv("LAVALINK_UNREACHABLE_AFTER", 3))
+LAVALINK_RESUME_TIMEOUT = int(os.getenv("LAVALINK_RESUME_TIMEOUT", 60))
+# Seconds before a Lavalink search or player update is abandoned, how many times timeouts and other
+# transient failures are retried, and the base delay between retries (doubled each time, with jitter)
+LAVALINK_TIMEOUT = float(os.getenv("LAVALINK_TIMEOUT", 10))
+LAVALINK_RETRIES = int(os.getenv("LAVALINK_RETRIES", 2))
+LAVALINK_RETRY_DELAY = float(os.getenv("LAVALINK_RETRY_DELAY", 0.5))
+# After this many failures in a row, a node's searches on that source (or its player updates)
+# fail fast for LAVALINK_BREAKER_COOLDOWN seconds
+LAVALINK_BREAKER_THRESHOLD = int(os.getenv("LAVALINK_BREAKER_THRESHOLD", 5))
+LAVALINK_BREAKER_COOLDOWN = float(os.getenv("LAVALINK_BREAKER_COOLDOWN", 30))
+
+# Volume new players start at, and how many finished tracks each guild remembers
+DEFAULT_VOLUME = int(os.getenv("DEFAULT_VOLUME", 15))
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", 50))
+# Most finished tracks remembered across all guilds. Past it, the least recently playing guilds lose their oldest tracks first
+HISTORY_BUDGET = int(os.getenv("HISTORY_BUDGET", 100000))
+
+# How many upcoming queued tracks are resolved ahead of playback, 0 disables prefetching
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", 2))
+
+# Search results cache, TTLs are in seconds
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1000))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 3600))
+SEARCH_CACHE_NEGATIVE_TTL = float(os.getenv("SEARCH_CACHE_NEGATIVE_TTL", 300))
+# Recent queries per guild offered by /play autocomplete
+RECENT_QUERY_LIMIT = int(os.getenv("RECENT_QUERY_LIMIT", 25))
+# Seconds typing must pause before /play autocomplete searches what was typed, and how many
+# of those partial searches are cached, apart from the search cache used to play tracks
+AUTOCOMPLETE_DELAY = float(os.getenv("AUTOCOMPLETE_DELAY", 0.75))
+AUTOCOMPLETE_CACHE_SIZE = int(os.getenv("AUTOCOMPLETE_CACHE_SIZE", 200))
+
+# Live player sessions are snapshotted every SESSION_SNAPSHOT_INTERVAL seconds and on shutdown
+# Each process of a split deployment keeps its own snapshot, as it only holds its own shards' players
+SESSIONS_PATH = BASE_DIR / (f"sessions-{'-'.join(map(str, SHARD_IDS))}.json" if SHARD_IDS else "sessions.json")
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv("SESSION_SNAPSHOT_INTERVAL", 30))
+
+# Playlist storage backend: "sqlite" (default) or "json". Use sqlite when running several processes
+PLAYLIST_STORE = os.getenv("PLAYLIST_STORE", "sqlite")
+PLAYLISTS_DB_PATH = BASE_DIR / "playlists.db"
+# Seconds between flushes of pending playlist changes, 0 writes every change immediately
+PLAYLIST_FLUSH_INTERVAL = float(os.getenv("PLAYLIST_FLUSH_INTERVAL", 5))
+
+# Seconds before an idle player leaves its voice channel, 0 disables that rule: alone in the
+# channel, paused, or with nothing left to play. Checked every IDLE_CHECK_INTERVAL seconds
+IDLE_ALONE_TIMEOUT = float(os.getenv("IDLE_ALONE_TIMEOUT", 120))
+IDLE_PAUSED_TIMEOUT = float(os.getenv("IDLE_PAUSED_TIMEOUT", 1800))
+IDLE_FINISHED_TIMEOUT = float(os.getenv("IDLE_FINISHED_TIMEOUT", 300))
+IDLE_CHECK_INTERVAL = float(os.getenv("IDLE_CHECK_INTERVAL", 15))
+# Whether to tell the home channel why the player left
+IDLE_FAREWELL = os.getenv("IDLE_FAREWELL", "true").lower() == "true"
+
+# Most playlist entries a guild can store across all its playlists
+PLAYLIST_GUILD_LIMIT = int(os.getenv("PLAYLIST_GUILD_LIMIT", 10000))
+# Playlist imports are saved IMPORT_CHUNK_SIZE tracks at a time, their progress message is updated every
+# IMPORT_PROGRESS_INTERVAL seconds, and unfinished imports are resumed after a restart
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 100))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", 3))
+IMPORTS_PATH = BASE_DIR / (f"imports-{'-'.join(map(str, SHARD_IDS))}.json" if SHARD_IDS else "imports.json")
+
+# How many player commands of a guild may wait while another one of its player commands runs
+COMMAND_BACKLOG = int(os.getenv("COMMAND_BACKLOG", 5))
+
+# Serve the latency histograms in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics, disabled if unset
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+
+# Seconds player notices wait to be merged with newer ones, and how many messages may be sent at once across all channels
+DISPATCH_MERGE_DELAY = float(os.getenv("DISPATCH_MERGE_DELAY", 1))
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", 10))
+
+# The discord.py log file, "json" writes one JSON object per line instead of text
+LOG_PATH = BASE_DIR / "logs" / "infos.log"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# The log file rotates at LOG_ROTATE_WHEN (e.g. "midnight", see TimedRotatingFileHandler) if set,
+# otherwise once it reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+# Most log records waiting for the writer thread, further records are dropped. 0 is unbounded
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
 
 def load_playlists():
     if os.path.exists(PLAYLISTS_PATH):
-        with open("playlists.json", 'r') as f:
+        with open(PLAYLISTS_PATH, 'r') as f:
             playlists = json.load(f)
-        return playlists 
+        return playlists
+    return {}
+
+def write_playlists(data: str):
+    write_atomic(PLAYLISTS_PATH, data)
+
+def load_sessions():
+    if os.path.exists(SESSIONS_PATH):
+        with open(SESSIONS_PATH, 'r') as f:
+            sessions = json.load(f)
+        return sessions
+    return {}
+
+def write_sessions(data: str):
+    write_atomic(SESSIONS_PATH, data)
+
+def load_imports():
+    if os.path.exists(IMPORTS_PATH):
+        with open(IMPORTS_PATH, 'r') as f:
+            imports = json.load(f)
+        return imports
+    return {}
 
-def save_playlists(playlists):
-    with open("playlists.json", 'w') as f:
-        json.dump(playlists, f, indent=4)
+def write_imports(data: str):
+    write_atomic(IMPORTS_PATH, data)
 
-playlists = load_playlists()
+def write_atomic(path: pathlib.Path, data: str):
+    """Atomically replace a file, a crash mid-write leaves the previous file intact."""
+    with metrics.span("file_write"):
+        temp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(temp_path, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+        # Make the rename itself durable
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+LOG_PATH.parent.mkdir(exist_ok=True)
+
+if LOG_ROTATE_WHEN:
+    LOG_FILE_HANDLER = {
+        "class": "logging.handlers.TimedRotatingFileHandler",
+        "when": LOG_ROTATE_WHEN
+    }
+else:
+    LOG_FILE_HANDLER = {
+        "class": "logging.handlers.RotatingFileHandler",
+        "maxBytes": LOG_MAX_BYTES
+    }
 
 LOGGING_CONFIG = {
     "version": 1,
-    "disabled_existing_Loggers": False,
+    "disable_existing_loggers": False,
     "formatters": {
         "verbose": {
             "format": "%(levelname)-10s - %(asctime)s - %(module)-15s : %(message)s"
         },
         "standard": {
             "format": "%(levelname)-10s - %(name)-15s : %(message)s"
+        },
+        "json": {
+            "()": "utils.logs.JsonFormatter"
         }
     },
     "handlers": {
@@ -56,14 +212,19 @@ LOGGING_CONFIG = {
             "formatter": "standard"
         },
         "file": {
+            **LOG_FILE_HANDLER,
             "level": "INFO",
-            "class": "logging.FileHandler",
-            "filename": "logs/infos.log",
-            "mode": "w",
-            "formatter": "verbose"
+            "filename": LOG_PATH,
+            "backupCount": LOG_BACKUP_COUNT,
+            "encoding": "utf-8",
+            "formatter": "json" if LOG_FORMAT == "json" else "verbose"
         }
     },
-    "Loggers": {
+    "root": {
+        "handlers": ["console", "file"],
+        "level": "INFO"
+    },
+    "loggers": {
         "bot": {
             "handlers": ["console"],
             "level": "INFO",
@@ -74,7 +235,9 @@ LOGGING_CONFIG = {
             "level": "INFO",
             "propagate": False
         }
-    } 
+    }
 }
 
 dictConfig(LOGGING_CONFIG)
+# Handlers write on a background thread, so a busy log never blocks the event loop
+log_pipeline.start([None, *LOGGING_CONFIG["loggers"]], LOG_QUEUE_SIZE)
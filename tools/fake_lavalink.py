@@ -0,0 +1,321 @@
+"""A stand-in for Lavalink, for running the bot against several local nodes without any audio.
+
+Implements the parts of the Lavalink v4 REST and websocket API the bot uses.
+Searches return made up tracks, players "play" by sending track start/end events
+on a timer, and stats report a configurable CPU load so node placement can be tested.
+
+    python tools/fake_lavalink.py --port 2333 --cpu 0.2
+    python tools/fake_lavalink.py --nodes 3 --port 2333
+
+With --nodes, one process is started per node on consecutive ports. Stopping one of
+them (or passing --lifetime) simulates a node going down. --latency delays every
+REST request and --error-rate makes that share of searches and player updates fail.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import multiprocessing
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+def make_track(identifier: str, title: str, author: str, length: int = 180_000) -> dict:
+    info = {
+        "identifier": identifier,
+        "isSeekable": True,
+        "author": author,
+        "length": length,
+        "isStream": False,
+        "position": 0,
+        "title": title,
+        "uri": f"https://www.youtube.com/watch?v={identifier}",
+        "artworkUrl": None,
+        "isrc": None,
+        "sourceName": "youtube"
+    }
+    encoded = base64.b64encode(json.dumps(info).encode()).decode()
+    return {"encoded": encoded, "info": info, "pluginInfo": {}, "userData": {}}
+
+def decode_track(encoded: str) -> dict:
+    info = json.loads(base64.b64decode(encoded))
+    return {"encoded": encoded, "info": info, "pluginInfo": {}, "userData": {}}
+
+class FakeLavalink:
+    def __init__(self, *, password: str, cpu: float, track_length: int, playlist_size: int, latency: float = 0, error_rate: float = 0) -> None:
+        self.password = password
+        self.cpu = cpu
+        self.track_length = track_length
+        self.playlist_size = playlist_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.started = time.monotonic()
+        self.sessions: dict[str, web.WebSocketResponse] = {}
+        self.players: dict[str, dict[str, dict]] = {}
+        self.timers: dict[tuple[str, str], asyncio.Task] = {}
+
+    # ==================== Helpers ==================== #
+
+    def authorized(self, request: web.Request) -> bool:
+        return request.headers.get("Authorization") == self.password
+
+    def failed(self) -> bool:
+        return random.random() < self.error_rate
+
+    def error(self, request: web.Request, status: int = 500) -> web.Response:
+        return web.json_response({
+            "timestamp": int(time.time() * 1000),
+            "status": status,
+            "error": "Internal Server Error",
+            "message": "Injected failure",
+            "path": request.path
+        }, status=status)
+
+    @web.middleware
+    async def delay(self, request: web.Request, handler) -> web.StreamResponse:
+        # Exponentially distributed around --latency, like a real node under varying load
+        if self.latency and request.path != "/v4/websocket":
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        return await handler(request)
+
+    def stats(self) -> dict:
+        players = [player for session in self.players.values() for player in session.values()]
+        return {
+            "players": len(players),
+            "playingPlayers": sum(1 for player in players if player["track"] and not player["paused"]),
+            "uptime": int((time.monotonic() - self.started) * 1000),
+            "memory": {"free": 0, "used": 0, "allocated": 0, "reservable": 0},
+            "cpu": {"cores": 1, "systemLoad": self.cpu, "lavalinkLoad": self.cpu},
+            "frameStats": {"sent": 3000, "nulled": 0, "deficit": 0}
+        }
+
+    async def send(self, session_id: str, payload: dict) -> None:
+        ws = self.sessions.get(session_id)
+        if ws and not ws.closed:
+            await ws.send_json(payload)
+
+    def load(self, identifier: str) -> dict:
+        seed = hashlib.sha1(identifier.encode()).hexdigest()
+        if "list=" in identifier or "/playlist/" in identifier:
+            tracks = [make_track(f"{seed[:8]}{i:03d}", f"Track {i} of {seed[:6]}", "Fake Artist", self.track_length) for i in range(self.playlist_size)]
+            return {"loadType": "playlist", "data": {"info": {"name": f"Playlist {seed[:6]}", "selectedTrack": -1}, "pluginInfo": {}, "tracks": tracks}}
+
+        query = identifier.split(":", 1)[-1]
+        return {"loadType": "search", "data": [make_track(seed[:11], query, "Fake Artist", self.track_length)]}
+
+    async def finish_track(self, session_id: str, guild_id: str, track: dict, delay: float) -> None:
+        await asyncio.sleep(delay)
+        player = self.players.get(session_id, {}).get(guild_id)
+        if not player or player["track"] is not track:
+            return
+        player["track"] = None
+        await self.send(session_id, {"op": "event", "type": "TrackEndEvent", "guildId": guild_id, "track": track, "reason": "finished"})
+
+    # ==================== REST ==================== #
+
+    async def version(self, request: web.Request) -> web.Response:
+        return web.Response(text="4.0.0-fake")
+
+    async def info(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "version": {"semver": "4.0.0", "major": 4, "minor": 0, "patch": 0, "preRelease": None, "build": None},
+            "buildTime": 0,
+            "git": {"branch": "fake", "commit": "fake", "commitTime": 0},
+            "jvm": "fake",
+            "lavaplayer": "fake",
+            "sourceManagers": ["youtube", "spotify"],
+            "filters": [],
+            "plugins": []
+        })
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        if not self.authorized(request):
+            return web.json_response({"status": 401}, status=401)
+        return web.json_response(self.stats())
+
+    async def load_tracks(self, request: web.Request) -> web.Response:
+        if not self.authorized(request):
+            return web.json_response({"status": 401}, status=401)
+        if self.failed():
+            return web.json_response({"loadType": "error", "data": {"message": "Injected failure", "severity": "fault", "cause": "fake"}})
+        return web.json_response(self.load(request.query.get("identifier", "")))
+
+    async def decode(self, request: web.Request) -> web.Response:
+        return web.json_response(decode_track(request.query["encodedTrack"]))
+
+    async def update_session(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        return web.json_response({"resuming": data.get("resuming", False), "timeout": data.get("timeout", 60)})
+
+    async def get_players(self, request: web.Request) -> web.Response:
+        session_id = request.match_info["session_id"]
+        return web.json_response(list(self.players.get(session_id, {}).values()))
+
+    async def update_player(self, request: web.Request) -> web.Response:
+        session_id = request.match_info["session_id"]
+        guild_id = request.match_info["guild_id"]
+        data = await request.json()
+        if self.failed():
+            return self.error(request)
+
+        players = self.players.setdefault(session_id, {})
+        player = players.setdefault(guild_id, {
+            "guildId": guild_id,
+            "track": None,
+            "volume": 100,
+            "paused": False,
+            "state": {"time": 0, "position": 0, "connected": True, "ping": 0},
+            "voice": {},
+            "filters": {}
+        })
+
+        for key in ("volume", "paused", "voice", "filters"):
+            if key in data:
+                player[key] = data[key]
+
+        track_data = data.get("track")
+        if track_data is None and "encodedTrack" in data:
+            track_data = {"encoded": data["encodedTrack"]}
+
+        if track_data is not None:
+            no_replace = request.query.get("noReplace") == "true"
+            if track_data.get("encoded") is None:
+                player["track"] = None
+            elif not (no_replace and player["track"]):
+                track = decode_track(track_data["encoded"])
+                track["userData"] = track_data.get("userData", {})
+                player["track"] = track
+                player["state"]["position"] = data.get("position", 0)
+                await self.send(session_id, {"op": "event", "type": "TrackStartEvent", "guildId": guild_id, "track": track})
+
+                remaining = (track["info"]["length"] - player["state"]["position"]) / 1000
+                timer = self.timers.pop((session_id, guild_id), None)
+                if timer:
+                    timer.cancel()
+                self.timers[(session_id, guild_id)] = asyncio.create_task(
+                    self.finish_track(session_id, guild_id, track, max(remaining, 0))
+                )
+
+        return web.json_response(player)
+
+    async def destroy_player(self, request: web.Request) -> web.Response:
+        session_id = request.match_info["session_id"]
+        guild_id = request.match_info["guild_id"]
+        self.players.get(session_id, {}).pop(guild_id, None)
+        timer = self.timers.pop((session_id, guild_id), None)
+        if timer:
+            timer.cancel()
+        return web.Response(status=204)
+
+    # ==================== Websocket ==================== #
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        if not self.authorized(request):
+            return web.Response(status=401)
+
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        session_id = request.headers.get("Session-Id")
+        resumed = session_id in self.players
+        if not resumed:
+            session_id = uuid.uuid4().hex[:16]
+        self.sessions[session_id] = ws
+        await ws.send_json({"op": "ready", "resumed": resumed, "sessionId": session_id})
+
+        async def send_stats() -> None:
+            while not ws.closed:
+                await ws.send_json({"op": "stats", **self.stats()})
+                await asyncio.sleep(60)
+
+        stats_task = asyncio.create_task(send_stats())
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            stats_task.cancel()
+            self.sessions.pop(session_id, None)
+        return ws
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.delay])
+        app.add_routes([
+            web.get("/version", self.version),
+            web.get("/v4/info", self.info),
+            web.get("/v4/stats", self.get_stats),
+            web.get("/v4/loadtracks", self.load_tracks),
+            web.get("/v4/decodetrack", self.decode),
+            web.patch("/v4/sessions/{session_id}", self.update_session),
+            web.get("/v4/sessions/{session_id}/players", self.get_players),
+            web.patch("/v4/sessions/{session_id}/players/{guild_id}", self.update_player),
+            web.delete("/v4/sessions/{session_id}/players/{guild_id}", self.destroy_player),
+            web.get("/v4/websocket", self.websocket)
+        ])
+        return app
+
+async def serve(host: str, port: int, lifetime: float | None, **kwargs) -> None:
+    runner = web.AppRunner(FakeLavalink(**kwargs).app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Fake Lavalink listening on http://{host}:{port}")
+    try:
+        if lifetime:
+            await asyncio.sleep(lifetime)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def run_node(host: str, port: int, lifetime: float | None, kwargs: dict) -> None:
+    try:
+        asyncio.run(serve(host, port, lifetime, **kwargs))
+    except KeyboardInterrupt:
+        pass
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=2333)
+    parser.add_argument("--password", default="youshallnotpass")
+    parser.add_argument("--nodes", type=int, default=1, help="number of node processes, on consecutive ports")
+    parser.add_argument("--cpu", type=float, default=0.1, help="system load reported in stats, the n-th node reports n times this")
+    parser.add_argument("--track-length", type=int, default=180_000, help="length of every track in milliseconds")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0, help="mean delay of REST requests in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of searches and player updates that fail")
+    parser.add_argument("--lifetime", type=float, default=None, help="stop the last node after this many seconds")
+    args = parser.parse_args()
+
+    processes = []
+    for i in range(args.nodes):
+        kwargs = {
+            "password": args.password,
+            "cpu": min(args.cpu * (i + 1), 1.0),
+            "track_length": args.track_length,
+            "playlist_size": args.playlist_size,
+            "latency": args.latency,
+            "error_rate": args.error_rate
+        }
+        lifetime = args.lifetime if i == args.nodes - 1 else None
+        process = multiprocessing.Process(target=run_node, args=(args.host, args.port + i, lifetime, kwargs))
+        process.start()
+        processes.append(process)
+
+    nodes = [
+        {"identifier": f"fake-{i}", "uri": f"http://{args.host}:{args.port + i}", "password": args.password}
+        for i in range(args.nodes)
+    ]
+    print(f"LAVALINK_NODES='{json.dumps(nodes)}'")
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""Load test for the music cogs, with fake Lavalink nodes and simulated guilds.
+
+Starts fake Lavalink nodes (see fake_lavalink.py) and drives the real MusicBot and
+PlaylistHandler cogs for every simulated guild: .play, .playlist play, .queue,
+.jump, .skip, .shuffle and .remove, then .stop and .leave. Discord itself is
+replaced by in-process guilds, channels and members, so no token is needed.
+
+    python tools/loadtest.py --guilds 500
+    python tools/loadtest.py --guilds 200 --nodes 2 --latency 0.05 --error-rate 0.02
+
+Reports throughput, command and stage latency percentiles, event loop lag,
+error counts and memory per guild.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import pathlib
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+
+# settings needs a guild id, and the bot's data files go to a scratch directory
+os.environ.setdefault("GUILD", "1")
+os.environ.setdefault("TOKEN", "loadtest")
+WORKDIR = pathlib.Path(tempfile.mkdtemp(prefix="loadtest-"))
+
+import settings
+from fake_lavalink import make_track, run_node
+
+import discord
+import wavelink
+
+# ==================== Simulated Discord ==================== #
+
+class FakeMessage:
+    def __init__(self, channel: "FakeTextChannel") -> None:
+        self.channel = channel
+
+    async def edit(self, **kwargs) -> "FakeMessage":
+        await self.channel.request(kwargs)
+        return self
+
+class FakeTextChannel:
+    """Text channel whose sends take a simulated Discord REST round trip."""
+
+    def __init__(self, id: int, guild: "FakeGuild", latency: float) -> None:
+        self.id = id
+        self.guild = guild
+        self.latency = latency
+        self.messages = 0
+        self.errors = 0
+
+    async def request(self, kwargs: dict) -> None:
+        await asyncio.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+        self.messages += 1
+        embed = kwargs.get("embed")
+        if embed and embed.color == discord.Color.dark_red():
+            self.errors += 1
+
+    async def send(self, **kwargs) -> FakeMessage:
+        await self.request(kwargs)
+        return FakeMessage(self)
+
+class FakeVoiceState:
+    def __init__(self, channel: "FakeVoiceChannel") -> None:
+        self.channel = channel
+
+class FakeMember:
+    def __init__(self, id: int, bot: bool = False, voice: FakeVoiceState | None = None) -> None:
+        self.id = id
+        self.bot = bot
+        self.voice = voice
+
+class FakeVoiceChannel:
+    def __init__(self, id: int, guild: "FakeGuild") -> None:
+        self.id = id
+        self.guild = guild
+        self.members: list[FakeMember] = []
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    async def connect(self, *, cls, **kwargs) -> wavelink.Player:
+        # What a voice handshake would leave behind, without the handshake
+        client = self.guild.client
+        player = cls(client, self)
+        player._guild = self.guild
+        player._connected = True
+        player.node._players[self.guild.id] = player
+        client._connection._add_voice_client(self.guild.id, player)
+        return player
+
+class FakeGuild:
+    def __init__(self, id: int, client: discord.Client, latency: float) -> None:
+        self.id = id
+        self.client = client
+        self.text = FakeTextChannel(id * 10 + 1, self, latency)
+        self.voice = FakeVoiceChannel(id * 10 + 2, self)
+        self.listener = FakeMember(id * 10 + 3, voice=FakeVoiceState(self.voice))
+        self.voice.members.append(self.listener)
+
+    @property
+    def voice_client(self):
+        return self.client._connection._get_voice_client(self.id)
+
+    def get_channel(self, id: int):
+        return {self.text.id: self.text, self.voice.id: self.voice}.get(id)
+
+    async def change_voice_state(self, **kwargs) -> None:
+        pass
+
+class FakeContext:
+    def __init__(self, bot: discord.Client, guild: FakeGuild) -> None:
+        self.bot = bot
+        self.guild = guild
+        self.channel = guild.text
+        self.author = guild.listener
+        self.invoked_subcommand = None
+        self.interaction = None
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, **kwargs) -> FakeMessage:
+        return await self.channel.send(**kwargs)
+
+# ==================== Measurements ==================== #
+
+def percentiles(samples: list[float], *quantiles: float) -> list[float]:
+    samples = sorted(samples)
+    if not samples:
+        return [0.0 for _ in quantiles]
+    return [samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles]
+
+async def monitor_loop_lag(samples: list[float], interval: float = 0.05) -> None:
+    """Record how late the event loop wakes up a task that sleeps for `interval`."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+async def wait_for_node(uri: str, timeout: float = 15) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{uri}/version") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.1)
+
+# ==================== Load Test ==================== #
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.errors: dict[str, int] = {}
+        self.commands = 0
+        self.lag: list[float] = []
+
+    async def command(self, label: str, command, cog, ctx: FakeContext, /, **kwargs) -> None:
+        from utils.metrics import metrics
+
+        start = time.perf_counter()
+        try:
+            await command.callback(cog, ctx, **kwargs)
+        except Exception as e:
+            key = f"{label}: {type(e).__name__}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+        finally:
+            metrics.observe("command", label, time.perf_counter() - start)
+            self.commands += 1
+        await asyncio.sleep(random.uniform(0, self.args.think))
+
+    async def play(self, bot, guild: FakeGuild) -> None:
+        """The commands of a guild until its queue is full."""
+        music, handler = bot.get_cog("MusicBot"), bot.get_cog("PlaylistHandler")
+        ctx = FakeContext(bot, guild)
+        await asyncio.sleep(random.uniform(0, self.args.ramp))
+
+        await self.command("play", music.play, music, ctx, query=f"song for guild {guild.id}")
+        await self.command("playlist play", handler.play, handler, ctx, name="bench")
+        await self.command("queue", music.queue, music, ctx)
+        await self.command("jump", music.jump, music, ctx, query="3")
+        await self.command("skip", music.skip, music, ctx)
+        await self.command("shuffle", music.shuffle, music, ctx)
+        await self.command("remove", music.remove, music, ctx, query="Track 1")
+
+    async def leave(self, bot, guild: FakeGuild) -> None:
+        music = bot.get_cog("MusicBot")
+        ctx = FakeContext(bot, guild)
+        await self.command("stop", music.stop, music, ctx)
+        await self.command("leave", music.leave, music, ctx)
+
+    async def seed_playlists(self, bot, guilds: list[FakeGuild]) -> None:
+        tracks = [
+            make_track(f"bench{i:06d}", f"Track {i}", "Fake Artist", self.args.track_length)
+            for i in range(self.args.playlist_size)
+        ]
+
+        from utils.tracks import track_to_entry
+        entries = [track_to_entry(wavelink.Playable(track)) for track in tracks]
+        for i, entry in enumerate(entries):
+            # Entries saved before encoded tracks were stored are searched when played
+            if random.random() < self.args.legacy_share:
+                entries[i] = {"title": entry["title"], "url": f"https://www.youtube.com/watch?v=legacy{i:06d}"}
+
+        for guild in guilds:
+            await bot.playlists.add(guild.id, "bench", entries)
+
+    async def run(self) -> None:
+        args = self.args
+        nodes = [
+            {"identifier": f"fake-{i}", "uri": f"http://127.0.0.1:{args.port + i}", "password": "youshallnotpass"}
+            for i in range(args.nodes)
+        ]
+        settings.LAVALINK_NODES = nodes
+        settings.PLAYLISTS_PATH = WORKDIR / "playlists.json"
+        settings.PLAYLISTS_DB_PATH = WORKDIR / "playlists.db"
+        settings.SESSIONS_PATH = WORKDIR / "sessions.json"
+        settings.IMPORTS_PATH = WORKDIR / "imports.json"
+        for node in nodes:
+            await wait_for_node(node["uri"])
+
+        from main import Bot, create_intents, memory_usage
+        from utils.metrics import metrics
+        from utils.nodes import balancer
+
+        bot = Bot(command_prefix=".", intents=create_intents())
+        bot._connection.user = discord.ClientUser(
+            state=bot._connection,
+            data={"id": 1, "username": "loadtest", "discriminator": "0000", "avatar": None}
+        )
+        # Entering the client sets up its loop, which event dispatch needs, and closing it cleans up the cogs
+        async with bot:
+            await bot.load_extension("cogs.music")
+            await bot.load_extension("cogs.playlist_handler")
+            while not balancer.connected_nodes():
+                await asyncio.sleep(0.1)
+
+            rss_start = memory_usage()
+            guilds = [FakeGuild(1000 + i, bot, args.discord_latency) for i in range(args.guilds)]
+            await self.seed_playlists(bot, guilds)
+
+            lag_task = asyncio.create_task(monitor_loop_lag(self.lag))
+            start = time.perf_counter()
+            await asyncio.gather(*(self.play(bot, guild) for guild in guilds))
+            rss_live = memory_usage()
+            players = len(bot.voice_clients)
+            await asyncio.gather(*(self.leave(bot, guild) for guild in guilds))
+            elapsed = time.perf_counter() - start
+            lag_task.cancel()
+
+            self.report(metrics, elapsed, guilds, players, rss_start, rss_live)
+            await wavelink.Pool.close()
+
+    def report(self, metrics, elapsed: float, guilds: list[FakeGuild], players: int, rss_start: int | None, rss_live: int | None) -> None:
+        print(f"\nGuilds: {len(guilds)} | Live players: {players} | Nodes: {self.args.nodes}")
+        print(f"Commands: {self.commands} in {elapsed:.2f}s ({self.commands / elapsed:.1f}/s)")
+
+        for kind in ("command", "stage"):
+            print(f"\n{kind.title():<16}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+            for name, count, p50, p95, p99 in metrics.summary(kind):
+                print(f"{name:<16}{count:>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+
+        p50, p99 = percentiles(self.lag, 0.5, 0.99)
+        print(f"\nEvent loop lag: p50 {p50 * 1000:.1f} ms | p99 {p99 * 1000:.1f} ms | max {max(self.lag, default=0) * 1000:.1f} ms")
+
+        messages = sum(guild.text.messages for guild in guilds)
+        replies = sum(guild.text.errors for guild in guilds)
+        print(f"Messages sent or edited: {messages} | Error replies: {replies}")
+        for error, count in sorted(self.errors.items()):
+            print(f"  {error}: {count}")
+
+        if rss_start is not None and rss_live is not None:
+            print(f"RSS: {rss_start / 2**20:.1f} MiB before, {rss_live / 2**20:.1f} MiB with every guild playing "
+                  f"({(rss_live - rss_start) / len(guilds) / 2**10:.1f} KiB per guild)")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--nodes", type=int, default=1, help="fake Lavalink nodes, one process each")
+    parser.add_argument("--port", type=int, default=23330, help="port of the first fake node")
+    parser.add_argument("--latency", type=float, default=0.01, help="mean Lavalink REST latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of Lavalink searches and player updates that fail")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="mean Discord message send latency in seconds")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument("--legacy-share", type=float, default=0.1, help="share of playlist entries without an encoded track")
+    parser.add_argument("--track-length", type=int, default=5_000, help="track length in milliseconds")
+    parser.add_argument("--think", type=float, default=0.05, help="most seconds a guild waits between commands")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which the guilds start")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    processes = []
+    for i in range(args.nodes):
+        kwargs = {
+            "password": "youshallnotpass",
+            "cpu": 0.1,
+            "track_length": args.track_length,
+            "playlist_size": args.playlist_size,
+            "latency": args.latency,
+            "error_rate": args.error_rate
+        }
+        process = multiprocessing.Process(target=run_node, args=("127.0.0.1", args.port + i, None, kwargs), daemon=True)
+        process.start()
+        processes.append(process)
+
+    try:
+        asyncio.run(LoadTest(args).run())
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+from collections import OrderedDict
+
+import settings
+from utils.cache import SearchCache, normalize_query
+from utils.tracks import fetch_tracks, search_cache
+
+from discord import app_commands
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+# Discord shows at most 25 choices, each name and value at most 100 characters long
+MAX_CHOICES = 25
+MAX_LENGTH = 100
+
+def choice(name: str, value: str) -> app_commands.Choice[str] | None:
+    if len(value) > MAX_LENGTH:
+        return None
+    if len(name) > MAX_LENGTH:
+        name = name[:MAX_LENGTH - 1] + "…"
+    return app_commands.Choice(name = name, value = value)
+
+# Results of what was typed so far, kept apart so partial queries never push played searches out of search_cache
+prefix_cache = SearchCache(
+    fetch_tracks,
+    capacity=settings.AUTOCOMPLETE_CACHE_SIZE,
+    ttl=settings.SEARCH_CACHE_TTL,
+    negative_ttl=settings.SEARCH_CACHE_NEGATIVE_TTL
+)
+
+def cached_search(query: str) -> "wavelink.Search | None":
+    for cache in (search_cache, prefix_cache):
+        result = cache.peek(query, wavelink.TrackSource.YouTube)
+        if result is not None:
+            return result
+    return None
+
+def track_choice(track: wavelink.Playable) -> app_commands.Choice[str] | None:
+    # The link plays exactly the suggested track
+    return choice(f"{track.title} - {track.author}", track.uri or track.title)
+
+class QuerySuggestions:
+    """Autocomplete for song queries that never waits on Lavalink.
+
+    Suggestions come from the guild's recent queries and from search results
+    already cached, for the longest cached prefix of what was typed. When the
+    text itself isn't cached yet, it is searched in the background once typing
+    pauses for `delay` seconds, at most one search per guild, so later
+    keystrokes find its results.
+    """
+
+    def __init__(self, limit: int, delay: float) -> None:
+        self.limit = limit
+        self.delay = delay
+        # Per guild, most recent last: value -> name
+        self.recent: dict[int, OrderedDict[str, str]] = {}
+        self.pending: dict[int, asyncio.Task] = {}
+        # Guilds whose pending search already went to Lavalink
+        self.searching: set[int] = set()
+
+    def remember(self, guild_id: int, query: str, track: wavelink.Playable | None = None) -> None:
+        """Record a query that found something. Links are shown by the title of what they found."""
+        if self.limit <= 0:
+            return
+
+        name = f"{track.title} - {track.author}" if track and "://" in query else query
+        recent = self.recent.setdefault(guild_id, OrderedDict())
+        recent.pop(query, None)
+        recent[query] = name
+        while len(recent) > self.limit:
+            recent.popitem(last = False)
+
+    def cached_results(self, text: str) -> list[wavelink.Playable] | None:
+        """Search results of the longest cached prefix of the text, narrowed down to the words typed."""
+        words = text.split()
+        for end in range(len(text), 2, -1):
+            result = cached_search(text[:end])
+            if result is None:
+                continue
+            tracks = list(result.tracks if isinstance(result, wavelink.Playlist) else result)
+            if end == len(text):
+                return tracks
+            return [
+                track for track in tracks
+                if all(word in f"{track.title} {track.author}".lower() for word in words)
+            ]
+        return None
+
+    def prefetch(self, guild_id: int, text: str) -> None:
+        """Search the text once typing pauses, unless the guild already has a search running."""
+        task = self.pending.get(guild_id)
+        if task and not task.done():
+            if guild_id in self.searching:
+                return
+            # Still waiting for typing to pause, the newer text replaces it
+            task.cancel()
+
+        async def search() -> None:
+            try:
+                await asyncio.sleep(self.delay)
+                self.searching.add(guild_id)
+                await prefix_cache.get(text, wavelink.TrackSource.YouTube)
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.debug(f"Autocomplete search for {text} failed: {e}")
+            finally:
+                if self.pending.get(guild_id) is current:
+                    del self.pending[guild_id]
+                    self.searching.discard(guild_id)
+
+        current = self.pending[guild_id] = asyncio.create_task(search())
+
+    def suggest(self, guild_id: int, current: str) -> list[app_commands.Choice[str]]:
+        text = normalize_query(current)
+        choices: list[app_commands.Choice[str]] = []
+
+        for value, name in reversed(self.recent.get(guild_id, {}).items()):
+            if text in name.lower() or text in value.lower():
+                choices.append(choice(name, value))
+
+        # Links are played as they are
+        if len(text) >= 3 and "://" not in text:
+            if cached_search(text) is None:
+                self.prefetch(guild_id, current)
+            choices.extend(track_choice(track) for track in self.cached_results(text) or [])
+
+        unique: dict[str, app_commands.Choice[str]] = {}
+        for item in choices:
+            if item and item.value not in unique:
+                unique[item.value] = item
+        return [*unique.values()][:MAX_CHOICES]
+
+def playlist_choices(names: list[str], current: str) -> list[app_commands.Choice[str]]:
+    """Playlist names starting with the text first, then those containing it."""
+    text = current.lower()
+    starting = [name for name in names if name.lower().startswith(text)]
+    containing = [name for name in names if text in name.lower() and not name.lower().startswith(text)]
+    choices = [choice(name, name) for name in starting + containing]
+    return [item for item in choices if item][:MAX_CHOICES]
+
+suggestions = QuerySuggestions(settings.RECENT_QUERY_LIMIT, settings.AUTOCOMPLETE_DELAY)
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+def normalize_query(query: str) -> str:
+    """Collapse whitespace, and ignore case unless the query is a URL (video ids are case sensitive)."""
+    query = " ".join(query.split())
+    if "://" in query:
+        return query
+    return query.lower()
+
+class SearchCache:
+    """LRU cache with a TTL in front of an async search function.
+
+    Results are keyed by normalized query and source. Empty results are cached
+    for `negative_ttl` seconds, and concurrent lookups of the same key share a single search.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str, Any], Awaitable[Any]],
+        *,
+        capacity: int,
+        ttl: float,
+        negative_ttl: float
+    ) -> None:
+        self.fetch = fetch
+        self.capacity = capacity
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self.inflight: dict[tuple[str, str], asyncio.Task] = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    async def get(self, query: str, source: Any = None) -> Any:
+        """Return the cached result for the query, searching if it is missing or expired."""
+        key = (normalize_query(query), str(source))
+
+        cached = self.entries.get(key)
+        if cached:
+            expires, result = cached
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                if result:
+                    self.hits += 1
+                else:
+                    self.negative_hits += 1
+                return result
+            del self.entries[key]
+
+        if key in self.inflight:
+            self.shared += 1
+        else:
+            self.misses += 1
+            self.inflight[key] = asyncio.create_task(self._fetch(key, query, source))
+
+        # A cancelled caller must not cancel the search for everyone waiting on it
+        return await asyncio.shield(self.inflight[key])
+
+    async def _fetch(self, key: tuple[str, str], query: str, source: Any) -> Any:
+        try:
+            result = await self.fetch(query, source)
+        finally:
+            del self.inflight[key]
+
+        self.put(key, result)
+        return result
+
+    def peek(self, query: str, source: Any = None) -> Any:
+        """Return the cached result for the query without searching, or None if it is missing or expired."""
+        cached = self.entries.get((normalize_query(query), str(source)))
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def put(self, key: tuple[str, str], result: Any) -> None:
+        ttl = self.ttl if result else self.negative_ttl
+        if ttl <= 0 or self.capacity <= 0:
+            return
+
+        self.entries[key] = (time.monotonic() + ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "evictions": self.evictions
+        }
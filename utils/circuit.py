@@ -0,0 +1,196 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from typing import Awaitable, Callable, TypeVar
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import settings
+from utils.nodes import balancer
+
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class LavalinkUnavailable(wavelink.WavelinkException):
+    """Raised when a Lavalink call can't be made or kept failing. The message is meant for users."""
+
+    def __init__(self, scope: str, retry_after: float | None = None) -> None:
+        self.scope = scope
+        self.retry_after = retry_after
+        if retry_after is None:
+            message = f"The music server is not responding to {scope} requests right now. Please try again later."
+        else:
+            message = f"The music server is having trouble with {scope} right now. Please try again in {max(1, round(retry_after))} seconds."
+        super().__init__(message)
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a failed call is worth retrying, and counts against the node."""
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError, wavelink.NodeException)):
+        return True
+    if isinstance(error, wavelink.LavalinkException):
+        return error.status >= 500 or error.status == 429
+    if isinstance(error, wavelink.LavalinkLoadException):
+        # "common" errors are about the track itself (e.g. unavailable), the others about the source or Lavalink
+        return error.severity != "common"
+    return False
+
+def search_scope(query: str, source: wavelink.TrackSource | str | None) -> str:
+    """Name of the source a search goes to, so a throttled source doesn't fail searches on the others."""
+    if "://" in query:
+        host = urlsplit(query).hostname or "link"
+        return host.removeprefix("www.")
+    if isinstance(source, wavelink.TrackSource):
+        return source.name
+    return source or "search"
+
+class CircuitBreaker:
+    """Stops calls to a failing node after `threshold` failures in a row.
+
+    While open, calls fail fast. After `cooldown` seconds one trial call is let
+    through: its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_at: float | None = None
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # A trial call that never reported back (e.g. cancelled) doesn't block the next one forever
+        if self.trial_at is not None and now - self.trial_at < self.cooldown:
+            return False
+        self.trial_at = now
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def failure(self) -> bool:
+        """Record a failure. Returns True if it opened the circuit."""
+        self.failures += 1
+        reopened = self.trial_at is not None
+        self.trial_at = None
+        if reopened or self.failures >= self.threshold:
+            was_open = self.opened_at is not None
+            self.opened_at = time.monotonic()
+            return not was_open
+        return False
+
+class LavalinkClient:
+    """Deadlines, jittered retries and a circuit breaker per node and scope around Lavalink calls.
+
+    A scope is a search source (e.g. "YouTube") or "playback", so a throttled
+    source only fails its own searches. Searches move on to the next least loaded
+    node whose circuit is closed, player calls stay on the player's node.
+    """
+
+    def __init__(self, *, timeout: float, retries: int, retry_delay: float, threshold: int, cooldown: float) -> None:
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers: dict[tuple[str, str], CircuitBreaker] = {}
+        self.counters: Counter = Counter()
+
+    def breaker(self, node: wavelink.Node, scope: str) -> CircuitBreaker:
+        key = (node.identifier, scope)
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(self.threshold, self.cooldown)
+        return self.breakers[key]
+
+    async def call(self, scope: str, nodes: Callable[[], list[wavelink.Node]], request: Callable[[wavelink.Node], Awaitable[T]], retry: bool = True) -> T:
+        """Make a request on the first of `nodes` whose circuit for the scope is closed.
+
+        Transient failures are retried if `retry`. Requests that would do something
+        else when repeated (e.g. a skip Lavalink applied before timing out) must not be.
+        """
+        error: BaseException | None = None
+        for attempt in range(self.retries + 1 if retry else 1):
+            candidates = nodes()
+            node = next((node for node in candidates if self.breaker(node, scope).allow()), None)
+            if node is None:
+                self.counters["rejected"] += 1
+                retry_after = min((self.breaker(node, scope).retry_after() for node in candidates), default=None)
+                raise LavalinkUnavailable(scope, retry_after) from error
+
+            breaker = self.breaker(node, scope)
+            self.counters["calls"] += 1
+            try:
+                result = await asyncio.wait_for(request(node), self.timeout)
+            except Exception as e:
+                if not is_transient(e):
+                    # The node answered, the request itself was the problem
+                    breaker.success()
+                    raise
+
+                error = e
+                self.counters["failures"] += 1
+                self.counters["timeouts"] += isinstance(e, asyncio.TimeoutError)
+                if breaker.failure():
+                    logger.warning(f"Pausing {scope} requests to Lavalink node {node.identifier} for {self.cooldown}s: {e!r}")
+            else:
+                breaker.success()
+                return result
+
+            if retry and attempt < self.retries:
+                self.counters["retries"] += 1
+                # Full jitter, so retries from many guilds don't hit the node in lockstep
+                await asyncio.sleep(random.uniform(0, self.retry_delay * 2 ** attempt))
+
+        raise LavalinkUnavailable(scope) from error
+
+    async def search(self, query: str, source: wavelink.TrackSource | str | None) -> wavelink.Search:
+        async def request(node: wavelink.Node) -> wavelink.Search:
+            if source is None:
+                return await wavelink.Playable.search(query, node=node)
+            return await wavelink.Playable.search(query, source=source, node=node)
+
+        return await self.call(search_scope(query, source), balancer.ranked_nodes, request)
+
+    async def play(self, player: wavelink.Player, request: Callable[[], Awaitable[T]], retry: bool = True) -> T:
+        return await self.call("playback", lambda: [player.node], lambda node: request(), retry)
+
+    def stats(self) -> dict:
+        calls = self.counters["calls"]
+        return {
+            "calls": calls,
+            "failures": self.counters["failures"],
+            "timeouts": self.counters["timeouts"],
+            "retries": self.counters["retries"],
+            "rejected": self.counters["rejected"],
+            "error_rate": self.counters["failures"] / calls if calls else 0.0,
+            "open_circuits": sum(breaker.open for breaker in self.breakers.values())
+        }
+
+lavalink = LavalinkClient(
+    timeout=settings.LAVALINK_TIMEOUT,
+    retries=settings.LAVALINK_RETRIES,
+    retry_delay=settings.LAVALINK_RETRY_DELAY,
+    threshold=settings.LAVALINK_BREAKER_THRESHOLD,
+    cooldown=settings.LAVALINK_BREAKER_COOLDOWN
+)
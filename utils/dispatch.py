@@ -0,0 +1,193 @@
+import asyncio
+from collections import Counter, OrderedDict, deque
+from typing import Callable
+
+import settings
+from utils.metrics import metrics
+
+import discord
+from discord.ext import commands
+
+logger = settings.logging.getLogger(__name__)
+
+class ChannelDispatcher:
+    """Sends the bot's messages to one channel, one request at a time.
+
+    Command replies go out first, in order. Player notices wait a moment so rapid
+    updates under the same key are merged into one, and notices marked as editable
+    update their previous message in place instead of posting a new one.
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, limiter: asyncio.Semaphore, on_idle: Callable[["ChannelDispatcher"], None]) -> None:
+        self.channel = channel
+        self.limiter = limiter
+        # Called once everything was sent, if no message is kept for editing
+        self.on_idle = on_idle
+        self.replies: deque[tuple[dict, asyncio.Future]] = deque()
+        self.notices: OrderedDict[object, tuple[bool, dict]] = OrderedDict()
+        # Last message of each editable notice key
+        self.messages: dict[object, discord.Message] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.sent = 0
+        self.edited = 0
+        self.merged = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.replies) + len(self.notices)
+
+    def reply(self, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.replies.append((kwargs, future))
+        self.wake()
+        return future
+
+    def notify(self, key: object, *, edit: bool = False, **kwargs) -> None:
+        if key in self.notices:
+            self.merged += 1
+        self.notices[key] = (edit, kwargs)
+        self.wake()
+
+    def forget(self, key: object) -> None:
+        """Post the next notice under this key as a new message."""
+        self.messages.pop(key, None)
+
+    def wake(self) -> None:
+        self.wakeup.set()
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while self.replies or self.notices:
+            if self.replies:
+                kwargs, future = self.replies.popleft()
+                try:
+                    message = await self.send(**kwargs)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(message)
+                continue
+
+            # Give rapid notices time to merge, unless a reply comes in
+            await self.wait_for_reply(settings.DISPATCH_MERGE_DELAY)
+            if self.replies:
+                continue
+
+            key, (edit, kwargs) = self.notices.popitem(last = False)
+            try:
+                await self.deliver(key, edit, kwargs)
+            except Exception as e:
+                logger.warning(f"Could not send a notice to channel {getattr(self.channel, 'id', None)}: {e}")
+
+        if not self.messages:
+            self.on_idle(self)
+
+    async def wait_for_reply(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        while not self.replies:
+            self.wakeup.clear()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def send(self, **kwargs) -> discord.Message:
+        async with self.limiter:
+            with metrics.span("message_send"):
+                message = await self.channel.send(**kwargs)
+        self.sent += 1
+        return message
+
+    async def deliver(self, key: object, edit: bool, kwargs: dict) -> None:
+        message = self.messages.get(key) if edit else None
+        if message:
+            try:
+                async with self.limiter:
+                    with metrics.span("message_edit"):
+                        self.messages[key] = await message.edit(**kwargs)
+                self.edited += 1
+                return
+            except discord.NotFound:
+                # Deleted by someone, post a new one
+                pass
+
+        message = await self.send(**kwargs)
+        if edit:
+            self.messages[key] = message
+
+class MessageDispatcher:
+    """Routes outgoing messages through one ChannelDispatcher per channel.
+
+    A channel's dispatcher only lives while it has messages to send or a message
+    to edit, so channels that only ever got command replies aren't kept around.
+    """
+
+    def __init__(self) -> None:
+        self.channels: dict[int, ChannelDispatcher] = {}
+        # Counters of the dispatchers that were dropped
+        self.retired: Counter = Counter()
+        # Shared by every channel, keeps bursts across guilds under the global rate limit
+        self.limiter: asyncio.Semaphore | None = None
+
+    def channel(self, channel: discord.abc.Messageable) -> ChannelDispatcher:
+        if self.limiter is None:
+            self.limiter = asyncio.Semaphore(settings.DISPATCH_CONCURRENCY)
+
+        dispatcher = self.channels.get(channel.id)
+        if not dispatcher:
+            dispatcher = self.channels[channel.id] = ChannelDispatcher(channel, self.limiter, self.release)
+        return dispatcher
+
+    def release(self, dispatcher: ChannelDispatcher) -> None:
+        """Drop a channel's dispatcher that has nothing left to send or edit."""
+        channel_id = dispatcher.channel.id
+        if self.channels.get(channel_id) is not dispatcher or dispatcher.messages or dispatcher.depth:
+            return
+        # Still delivering, it releases itself once done
+        if dispatcher.task and not dispatcher.task.done() and dispatcher.task is not asyncio.current_task():
+            return
+        del self.channels[channel_id]
+        self.retired.update(sent = dispatcher.sent, edited = dispatcher.edited, merged = dispatcher.merged)
+
+    async def reply(self, ctx: commands.Context, **kwargs) -> discord.Message:
+        """Send a command reply ahead of any pending notices of the command's channel.
+
+        Slash commands are answered through their interaction instead, which has its own rate limit.
+        """
+        if ctx.interaction:
+            return await ctx.send(**kwargs)
+        return await self.channel(ctx.channel).reply(**kwargs)
+
+    def notify(self, channel: discord.abc.Messageable | None, key: object, *, edit: bool = False, **kwargs) -> None:
+        """Queue a notice, replacing any pending notice of the channel with the same key."""
+        if channel is None:
+            return
+        self.channel(channel).notify(key, edit = edit, **kwargs)
+
+    def forget(self, channel: discord.abc.Messageable | None, key: object) -> None:
+        dispatcher = self.channels.get(channel.id) if channel else None
+        if dispatcher:
+            dispatcher.forget(key)
+            self.release(dispatcher)
+
+    def stats(self) -> dict:
+        """Queue depth and message counters across all channels."""
+        depths = [dispatcher.depth for dispatcher in self.channels.values()]
+        return {
+            "channels": len(self.channels),
+            "queued": sum(depths),
+            "max_depth": max(depths, default = 0),
+            "sent": self.retired["sent"] + sum(dispatcher.sent for dispatcher in self.channels.values()),
+            "edited": self.retired["edited"] + sum(dispatcher.edited for dispatcher in self.channels.values()),
+            "merged": self.retired["merged"] + sum(dispatcher.merged for dispatcher in self.channels.values())
+        }
+
+dispatcher = MessageDispatcher()
@@ -0,0 +1,165 @@
+import time
+from array import array
+from collections import OrderedDict
+
+import settings
+from utils.storage import TrackEntry, track_table
+from utils.tracks import track_to_entry
+
+import wavelink
+
+def history_entry(track: wavelink.Playable) -> TrackEntry:
+    """The entry of a played track, shared with playlists and other guilds.
+
+    Prefetched mirrors keep the info of the track that was queued in their own
+    entry, so it doesn't leak into playlists saving the mirror itself.
+    """
+    entry = track_to_entry(track)
+    extras = dict(track.extras)
+    if extras:
+        entry["userData"] = extras
+        return TrackEntry(entry)
+    return track_table.intern(entry)
+
+class HistoryRing:
+    """Fixed-size ring buffer of played tracks, the oldest is overwritten when it's full.
+
+    Slots are allocated once. Each holds a shared track entry, when it was played
+    and the number of the player session it was played in.
+    """
+    __slots__ = ("entries", "times", "sessions", "start", "length", "recorded")
+
+    def __init__(self, size: int) -> None:
+        self.entries: list[TrackEntry | None] = [None] * size
+        self.times = array("d", [0.0]) * size
+        self.sessions = array("L", [0]) * size
+        self.start = 0
+        self.length = 0
+        # Changes on every append, for telling rendered pages apart
+        self.recorded = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def slot(self, i: int) -> int:
+        """Slot of the i-th newest entry."""
+        return (self.start + self.length - 1 - i) % len(self.entries)
+
+    def append(self, entry: TrackEntry, played_at: float, session: int) -> bool:
+        """Add the newest entry. Returns True if the oldest one was overwritten to make room."""
+        size = len(self.entries)
+        slot = (self.start + self.length) % size
+        self.entries[slot] = entry
+        self.times[slot] = played_at
+        self.sessions[slot] = session
+        self.recorded += 1
+
+        if self.length == size:
+            self.start = (self.start + 1) % size
+            return True
+        self.length += 1
+        return False
+
+    def pop_oldest(self) -> None:
+        self.entries[self.start] = None
+        self.start = (self.start + 1) % len(self.entries)
+        self.length -= 1
+
+    def pop_newest(self) -> TrackEntry:
+        slot = self.slot(0)
+        entry = self.entries[slot]
+        self.entries[slot] = None
+        self.length -= 1
+        self.recorded += 1
+        return entry
+
+    def get(self, i: int) -> tuple[TrackEntry, float, int]:
+        """The i-th newest entry, when it was played and its session."""
+        slot = self.slot(i)
+        return self.entries[slot], self.times[slot], self.sessions[slot]
+
+class PlayHistory:
+    """The recently played tracks of every guild, within a global budget.
+
+    Each guild keeps its last `size` tracks. When all guilds together hold more
+    than `budget`, the guilds that played least recently lose their oldest tracks
+    first. Track data is shared with playlists and other guilds through the track
+    table, so the budget counts entries rather than bytes.
+    """
+
+    def __init__(self, size: int, budget: int) -> None:
+        self.size = size
+        self.budget = budget
+        # Least recently playing guild first
+        self.guilds: OrderedDict[int, HistoryRing] = OrderedDict()
+        self.last_sessions: dict[int, int] = {}
+        self.total = 0
+        self.overwritten = 0
+        self.evicted = 0
+
+    def new_session(self, guild_id: int) -> int:
+        """Number the tracks of a new player session of the guild, so it can be replayed later."""
+        session = self.last_sessions.get(guild_id, 0) + 1
+        self.last_sessions[guild_id] = session
+        return session
+
+    def record(self, guild_id: int, track: wavelink.Playable, session: int) -> None:
+        if self.size <= 0:
+            return
+
+        ring = self.guilds.get(guild_id)
+        if ring is None:
+            ring = self.guilds[guild_id] = HistoryRing(self.size)
+        self.guilds.move_to_end(guild_id)
+
+        if ring.append(history_entry(track), time.time(), session):
+            self.overwritten += 1
+        else:
+            self.total += 1
+
+        while self.total > self.budget:
+            oldest_guild, oldest = next(iter(self.guilds.items()))
+            oldest.pop_oldest()
+            self.total -= 1
+            self.evicted += 1
+            if not oldest:
+                del self.guilds[oldest_guild]
+
+    def ring(self, guild_id: int) -> HistoryRing | None:
+        return self.guilds.get(guild_id)
+
+    def __len__(self) -> int:
+        return self.total
+
+    def previous(self, guild_id: int) -> TrackEntry | None:
+        """Take the most recently finished track out of the history, so asking again goes further back."""
+        ring = self.guilds.get(guild_id)
+        if not ring:
+            return None
+
+        entry = ring.pop_newest()
+        self.total -= 1
+        if not ring:
+            del self.guilds[guild_id]
+        return entry
+
+    def last_session(self, guild_id: int, exclude: int | None = None) -> list[TrackEntry]:
+        """Tracks of the guild's most recent player session other than `exclude`, in the order they played."""
+        ring = self.guilds.get(guild_id)
+        if not ring:
+            return []
+
+        played = [ring.get(i) for i in range(len(ring))]
+        session = next((session for _, _, session in played if session != exclude), None)
+        return [entry for entry, _, played_in in reversed(played) if played_in == session]
+
+    def stats(self) -> dict:
+        return {
+            "guilds": len(self.guilds),
+            "entries": self.total,
+            "budget": self.budget,
+            "overwritten": self.overwritten,
+            "evicted": self.evicted
+        }
+
+history = PlayHistory(settings.HISTORY_SIZE, settings.HISTORY_BUDGET)
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import time
+import uuid
+
+import settings
+from utils.dispatch import dispatcher
+from utils.lanes import LaneBusy, lanes
+from utils.nodes import balancer
+from utils.pagination import create_green_embed, create_red_embed
+from utils.playlists import PlaylistRepository
+from utils.tracks import search_tracks, track_to_entry
+
+import discord
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+def entry_keys(entry: dict) -> set[str]:
+    """Keys identifying the song of a playlist entry, for finding duplicates across sources."""
+    keys = set()
+    if entry.get("url"):
+        keys.add(entry["url"])
+    isrc = entry.get("info", {}).get("isrc")
+    if isrc:
+        keys.add(f"isrc:{isrc}")
+    return keys
+
+class ImportJob:
+    """Progress of one playlist import, saved after every chunk so it can resume after a restart."""
+
+    def __init__(self, guild_id: int, channel_id: int | None, name: str, query: str, **progress) -> None:
+        self.id: str = progress.get("id") or uuid.uuid4().hex
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.name = name
+        self.query = query
+        self.source: str = progress.get("source", query)
+        self.total: int = progress.get("total", 0)
+        self.offset: int = progress.get("offset", 0)
+        self.added: int = progress.get("added", 0)
+        self.duplicates: int = progress.get("duplicates", 0)
+        self.skipped: int = progress.get("skipped", 0)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "name": self.name,
+            "query": self.query,
+            "source": self.source,
+            "total": self.total,
+            "offset": self.offset,
+            "added": self.added,
+            "duplicates": self.duplicates,
+            "skipped": self.skipped
+        }
+
+    def embed(self, finished: bool = False) -> discord.Embed:
+        status = "Imported" if finished else f"Importing ({self.offset}/{self.total})"
+        description = f"{status} **{self.source}** into **{self.name}**: {self.added} songs added"
+        if self.duplicates:
+            description += f", {self.duplicates} already in the playlist"
+        if self.skipped:
+            description += f", {self.skipped} over the limit of {settings.PLAYLIST_GUILD_LIMIT} songs per server"
+        return create_green_embed(description=description + ".")
+
+class PlaylistImporter:
+    """Imports large playlists in the background, a chunk at a time.
+
+    Duplicates of songs already in the playlist (same url or ISRC) are skipped, and
+    nothing is added past the per-guild limit. Owned by the bot, so imports keep
+    running across cog reloads.
+    """
+
+    def __init__(self, playlists: PlaylistRepository) -> None:
+        self.playlists = playlists
+        self.jobs: dict[str, ImportJob] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.lock = asyncio.Lock()
+        self.resumed = False
+
+    def start(self, job: ImportJob, channel: discord.abc.Messageable | None, tracks: list[wavelink.Playable] | None = None) -> None:
+        """Run an import in the background. Without tracks, the job's query is searched again."""
+        self.jobs[job.id] = job
+        task = self.tasks[job.id] = asyncio.create_task(self.run(job, channel, tracks))
+        task.add_done_callback(lambda _: self.tasks.pop(job.id, None))
+
+    async def run(self, job: ImportJob, channel: discord.abc.Messageable | None, tracks: list[wavelink.Playable] | None) -> None:
+        key = ("import", job.id)
+        try:
+            if tracks is None:
+                tracks = await self.search(job.query)
+            job.total = len(tracks)
+            await self.save()
+            dispatcher.notify(channel, key, edit=True, embed=job.embed())
+
+            last_progress = time.monotonic()
+
+            while job.offset < len(tracks):
+                chunk = tracks[job.offset:job.offset + settings.IMPORT_CHUNK_SIZE]
+                try:
+                    await self.add_chunk(job, chunk)
+                except LaneBusy:
+                    await asyncio.sleep(1)
+                    continue
+                job.offset += len(chunk)
+
+                if time.monotonic() - last_progress >= settings.IMPORT_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    # Entries are written before the offset that covers them, a resumed import
+                    # repeats at most the last chunks, which are then skipped as duplicates
+                    await self.playlists.flush()
+                    await self.save()
+                    dispatcher.notify(channel, key, edit=True, embed=job.embed())
+
+                # Let other commands run between chunks
+                await asyncio.sleep(0)
+
+            await self.playlists.flush()
+            dispatcher.notify(channel, key, edit=True, embed=job.embed(finished=True))
+        except asyncio.CancelledError:
+            # Stopped by shutdown, the saved job resumes on the next start
+            raise
+        except Exception as e:
+            logger.warning(f"Import of {job.query} into playlist {job.name} of guild {job.guild_id} failed: {e}")
+            embed: discord.Embed = create_red_embed(
+                description=f"Could not import **{job.source}** into **{job.name}**. {job.added} songs were added."
+            )
+            dispatcher.notify(channel, key, edit=True, embed=embed)
+
+        del self.jobs[job.id]
+        await self.save()
+
+    async def add_chunk(self, job: ImportJob, chunk: list[wavelink.Playable]) -> None:
+        # Commands and other imports change the guild's playlists between chunks
+        async with lanes.hold(job.guild_id):
+            existing = await self.playlists.get(job.guild_id, job.name) or []
+            seen: set[str] = set().union(*(entry_keys(entry) for entry in existing))
+            room = settings.PLAYLIST_GUILD_LIMIT - await self.playlists.size(job.guild_id)
+
+            entries = []
+            for track in chunk:
+                entry = track_to_entry(track)
+                keys = entry_keys(entry)
+                if keys & seen:
+                    job.duplicates += 1
+                elif len(entries) >= room:
+                    job.skipped += 1
+                else:
+                    seen |= keys
+                    entries.append(entry)
+
+            if entries:
+                await self.playlists.add(job.guild_id, job.name, entries)
+                job.added += len(entries)
+
+    async def search(self, query: str) -> list[wavelink.Playable]:
+        # Resumed imports start before the Lavalink nodes have connected
+        for _ in range(60):
+            if balancer.connected_nodes():
+                break
+            await asyncio.sleep(1)
+
+        tracks: wavelink.Search = await search_tracks(query)
+        if isinstance(tracks, wavelink.Playlist):
+            return tracks.tracks
+        return list(tracks)
+
+    async def save(self) -> None:
+        async with self.lock:
+            data = json.dumps({job_id: job.to_dict() for job_id, job in self.jobs.items()})
+            await asyncio.to_thread(settings.write_imports, data)
+
+    async def resume(self, bot: discord.Client) -> None:
+        """Restart the imports that were still running when the bot stopped."""
+        if self.resumed:
+            return
+        self.resumed = True
+
+        try:
+            saved: dict = await asyncio.to_thread(settings.load_imports)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the saved playlist imports: {e}")
+            return
+
+        for data in saved.values():
+            job = ImportJob(**data)
+            channel = bot.get_channel(job.channel_id) if job.channel_id else None
+            logger.info(f"Resuming import of {job.query} into playlist {job.name} of guild {job.guild_id} at {job.offset}/{job.total}")
+            self.start(job, channel)
+
+    async def close(self) -> None:
+        """Stop running imports, keeping them saved to resume on the next start."""
+        tasks = [*self.tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,90 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import settings
+from utils.dispatch import dispatcher
+from utils.pagination import create_red_embed
+
+import discord
+from discord.ext import commands
+
+logger = settings.logging.getLogger(__name__)
+
+class LaneBusy(Exception):
+    """Raised when too many commands are already waiting in a guild's lane."""
+
+class GuildLane:
+    """Lets one command at a time change a guild's player. Reentrant for the command holding it."""
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.owner: asyncio.Task | None = None
+        self.waiting = 0
+
+class CommandLanes:
+    """One lane per guild, so commands of different guilds never wait for each other."""
+
+    def __init__(self, backlog: int) -> None:
+        self.backlog = backlog
+        self.lanes: dict[int, GuildLane] = {}
+
+    @asynccontextmanager
+    async def hold(self, guild_id: int, wait: bool = True) -> AsyncIterator[None]:
+        """Hold the guild's lane. Without `wait`, raises LaneBusy instead of waiting for it."""
+        lane = self.lanes.get(guild_id)
+        if lane is None:
+            lane = self.lanes[guild_id] = GuildLane()
+
+        # A command calling another one (e.g. play calling join) already holds the lane
+        task = asyncio.current_task()
+        if lane.owner is task:
+            yield
+            return
+
+        if lane.lock.locked() and (not wait or lane.waiting >= self.backlog):
+            raise LaneBusy()
+
+        lane.waiting += 1
+        try:
+            await lane.lock.acquire()
+        finally:
+            lane.waiting -= 1
+
+        lane.owner = task
+        try:
+            yield
+        finally:
+            lane.owner = None
+            lane.lock.release()
+            if not lane.waiting and not lane.lock.locked():
+                del self.lanes[guild_id]
+
+    def stats(self) -> dict:
+        return {
+            "busy": len(self.lanes),
+            "waiting": sum(lane.waiting for lane in self.lanes.values())
+        }
+
+lanes = CommandLanes(settings.COMMAND_BACKLOG)
+
+def player_command(func):
+    """Run a command that changes the guild's player in the guild's lane.
+
+    Commands that only read the player skip the lane and never wait.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, ctx: commands.Context, *args, **kwargs):
+        if not ctx.guild:
+            return await func(self, ctx, *args, **kwargs)
+
+        try:
+            async with lanes.hold(ctx.guild.id):
+                return await func(self, ctx, *args, **kwargs)
+        except LaneBusy:
+            embed: discord.Embed = create_red_embed(
+                description="I'm still working on the previous commands in this server, please try again in a moment."
+            )
+            await dispatcher.reply(ctx, embed=embed)
+    return wrapper
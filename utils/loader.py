@@ -0,0 +1,109 @@
+import asyncio
+
+import settings
+from utils.tracks import resolve_entry, stream_entries
+from utils.dispatch import dispatcher
+from utils.circuit import LavalinkUnavailable
+from utils.pagination import create_green_embed, create_red_embed
+from utils.playlists import PlaylistRepository
+from utils.player import MusicPlayer
+
+import discord
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+class PlaylistLoader:
+    """Streams a saved playlist into a player's queue.
+
+    The first playable track is resolved right away so playback can start,
+    the remaining entries are resolved by a background task that keeps the playlist order.
+    """
+    player: MusicPlayer
+    playlists: PlaylistRepository
+    guild_id: int
+    name: str
+    playlist: list
+    entries: list
+    failed: int
+    added: int
+    upgraded: int
+    # Why loading stopped early, if Lavalink became unavailable
+    unavailable: LavalinkUnavailable | None
+    task: asyncio.Task | None
+
+    def __init__(self, player: MusicPlayer, playlists: PlaylistRepository, guild_id: int, name: str, playlist: list) -> None:
+        self.player = player
+        self.playlists = playlists
+        self.guild_id = guild_id
+        self.name = name
+        self.playlist = playlist
+        self.entries = playlist
+        self.failed = 0
+        self.added = 0
+        self.upgraded = 0
+        self.unavailable = None
+        self.task = None
+
+    async def resolve_first(self) -> wavelink.Playable | None:
+        """Resolve entries until one is playable. Returns None if none of them could be found."""
+        for i, entry in enumerate(self.entries):
+            legacy = "encoded" not in entry
+            track = await resolve_entry(entry)
+            if track:
+                self.upgraded += legacy
+                self.entries = self.entries[i + 1:]
+                self.added += 1
+                return track
+            self.failed += 1
+        self.entries = []
+        return None
+
+    def start(self) -> None:
+        """Resolve the remaining entries in the background."""
+        self.task = asyncio.create_task(self.load_remaining())
+        self.player.session.loaders.add(self.task)
+        self.task.add_done_callback(self.player.session.loaders.discard)
+
+    async def load_remaining(self) -> None:
+        legacy = {id(entry) for entry in self.entries if "encoded" not in entry}
+        try:
+            tracks = stream_entries(self.entries, settings.PLAYLIST_SEARCH_CONCURRENCY)
+            try:
+                for entry in self.entries:
+                    track = await anext(tracks)
+                    if not track:
+                        self.failed += 1
+                        continue
+                    self.upgraded += id(entry) in legacy
+                    await self.player.queue.put_wait(track)
+                    self.added += 1
+            finally:
+                await tracks.aclose()
+        except LavalinkUnavailable as e:
+            # The remaining songs would all fail the same way
+            logger.warning(f"Stopped loading playlist {self.name} after {self.added} songs: {e}")
+            self.unavailable = e
+        except asyncio.CancelledError:
+            logger.info(f"Stopped loading playlist {self.name} after {self.added} songs")
+            raise
+        finally:
+            # Persist the encoded tracks of upgraded entries
+            if self.upgraded:
+                await self.playlists.update(self.guild_id, self.name)
+
+        await self.report()
+
+    async def report(self) -> None:
+        """Tell the home channel how many songs could not be loaded."""
+        if self.unavailable:
+            embed: discord.Embed = create_red_embed(
+                description=f"Stopped loading playlist **{self.name}** after {self.added} songs. {self.unavailable}"
+            )
+        elif self.failed:
+            embed: discord.Embed = create_green_embed(
+                description=f"Finished loading playlist **{self.name}**: {self.added} songs added, {self.failed} could not be found."
+            )
+        else:
+            return
+        dispatcher.notify(self.player.session.home, ("playlist", self.name), embed=embed)
@@ -0,0 +1,110 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+from typing import Iterable
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers and `jq`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+class PipelineHandler(logging.handlers.QueueHandler):
+    """Hands records to the pipeline's writer thread, along with the handlers they are meant for."""
+
+    def __init__(self, pipeline: "LogPipeline", targets: tuple[logging.Handler, ...]) -> None:
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self.targets = targets
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Render what depends on the caller's state now, the writer formats the rest
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.log_targets = self.targets
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # Never wait for the writer, a full queue drops the record instead
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+class PipelineListener(logging.handlers.QueueListener):
+    """Writer thread passing every record to the handlers of the logger it came from."""
+
+    def handle(self, record: logging.LogRecord) -> None:
+        for handler in record.log_targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue_sentinel(self) -> None:
+        # Wait for room, so stopping never loses the records still queued
+        self.queue.put(self._sentinel)
+
+class LogPipeline:
+    """Moves the handlers of configured loggers onto one background writer thread.
+
+    Logging calls only copy the record into a bounded queue, so a slow disk or
+    terminal never blocks the event loop. When the queue is full, records are
+    dropped and counted rather than waited on.
+    """
+
+    def __init__(self) -> None:
+        self.queue: queue.Queue = queue.Queue()
+        self.listener: PipelineListener | None = None
+        self.handlers: list[logging.Handler] = []
+        self.dropped = 0
+
+    def start(self, names: Iterable[str | None], queue_size: int = 0) -> None:
+        """Route the loggers with these names (None for the root logger) through the pipeline."""
+        self.queue = queue.Queue(queue_size)
+        for name in names:
+            logger = logging.getLogger(name)
+            targets = tuple(logger.handlers)
+            if not targets:
+                continue
+            for handler in targets:
+                logger.removeHandler(handler)
+            logger.addHandler(PipelineHandler(self, targets))
+            self.handlers.extend(handler for handler in targets if handler not in self.handlers)
+
+        self.listener = PipelineListener(self.queue)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Write out the queued records and close the handlers."""
+        if not self.listener:
+            return
+        self.listener.stop()
+        self.listener = None
+        for handler in self.handlers:
+            handler.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped
+        }
+
+log_pipeline = LogPipeline()
@@ -0,0 +1,123 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# Upper bounds, in seconds, of the cumulative buckets exported to Prometheus
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """Latency distribution of one command or stage.
+
+    Keeps cumulative buckets for Prometheus and the latest `window` samples for
+    exact percentiles of recent traffic.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples: deque[float] = deque(maxlen=window)
+        # Some stages are timed from worker threads
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+            self.samples.append(seconds)
+
+    def percentiles(self, *quantiles: float) -> list[float]:
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return [0.0 for _ in quantiles]
+        return [samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles]
+
+class Metrics:
+    """In-process latency histograms per command and per stage, and gauges read when reported."""
+
+    def __init__(self) -> None:
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.gauges: dict[str, Callable[[], dict]] = {}
+
+    def observe(self, kind: str, name: str, seconds: float) -> None:
+        histogram = self.histograms.get((kind, name))
+        if histogram is None:
+            histogram = self.histograms.setdefault((kind, name), Histogram())
+        histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Time a stage. Works around awaits, timing the stage's wall clock duration."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage", stage, time.perf_counter() - start)
+
+    def register_gauges(self, name: str, read: Callable[[], dict]) -> None:
+        """Report the numbers returned by `read` under `name`."""
+        self.gauges[name] = read
+
+    def read_gauges(self) -> dict[str, dict]:
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:
+                continue
+        return gauges
+
+    def summary(self, kind: str) -> list[tuple[str, int, float, float, float]]:
+        """Name, count and p50/p95/p99 in milliseconds of every histogram of a kind, slowest p95 first."""
+        rows = []
+        for (histogram_kind, name), histogram in self.histograms.items():
+            if histogram_kind == kind:
+                p50, p95, p99 = histogram.percentiles(0.5, 0.95, 0.99)
+                rows.append((name, histogram.count, p50 * 1000, p95 * 1000, p99 * 1000))
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def render_prometheus(self) -> str:
+        """Every histogram and gauge in the Prometheus text exposition format."""
+        lines = []
+        for kind in ("command", "stage"):
+            metric = f"discord_bot_{kind}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (histogram_kind, name), histogram in sorted(self.histograms.items()):
+                if histogram_kind != kind:
+                    continue
+                with histogram.lock:
+                    buckets, count, total = list(histogram.buckets), histogram.count, histogram.sum
+                cumulative = 0
+                for bound, bucket in zip((*BUCKETS, "+Inf"), buckets):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{{kind}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{kind}="{name}"}} {total}')
+                lines.append(f'{metric}_count{{{kind}="{name}"}} {count}')
+
+        for name, values in self.read_gauges().items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    # Python writes nan and inf, Prometheus expects NaN and +Inf
+                    lines.append(f"discord_bot_{name}_{key} {value!r}".replace("nan", "NaN").replace("inf", "+Inf"))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def start_metrics_server(host: str, port: int):
+    """Serve `metrics.render_prometheus()` on /metrics. Returns the runner, to clean up on shutdown."""
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,117 @@
+import functools
+
+import settings
+
+import discord
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+def create_nodes() -> list[wavelink.Node]:
+    """Create the Lavalink nodes listed in the LAVALINK_NODES setting."""
+    return [
+        wavelink.Node(
+            identifier = node["identifier"],
+            uri = node["uri"],
+            password = node["password"],
+            resume_timeout = settings.LAVALINK_RESUME_TIMEOUT,
+            # Idle players are handled by utils.reaper, not by a wavelink task per player
+            inactive_player_timeout = None
+        )
+        for node in settings.LAVALINK_NODES
+    ]
+
+def node_penalty(node: wavelink.Node, stats: wavelink.StatsResponsePayload | None) -> float:
+    """Load score of a node, lower is better. Uses the same weights as Lavalink's own load balancer."""
+    # Live player count, so players placed since the last stats update are counted
+    penalty = float(len(node.players))
+    if not stats:
+        return penalty
+
+    penalty += 1.05 ** (100 * stats.cpu.system_load) * 10 - 10
+
+    frames = stats.frames
+    if frames and frames.deficit != -1:
+        penalty += 1.03 ** (500 * frames.deficit / 3000) * 600 - 600
+        penalty += (1.03 ** (500 * frames.nulled / 3000) * 300 - 300) * 2
+    return penalty
+
+class NodeBalancer:
+    """Places new players on the least loaded Lavalink node and moves players off nodes that went down.
+
+    A node whose websocket is up is only considered down after `unreachable_after`
+    failed stats requests in a row, so one slow answer doesn't move every player.
+    """
+
+    def __init__(self, unreachable_after: int) -> None:
+        self.unreachable_after = unreachable_after
+        self.stats: dict[str, wavelink.StatsResponsePayload] = {}
+        # Failed stats requests in a row, per node
+        self.failures: dict[str, int] = {}
+        # Nodes whose websocket is still up but that stopped answering requests
+        self.unreachable: set[str] = set()
+
+    def is_healthy(self, node: wavelink.Node) -> bool:
+        return node.status is wavelink.NodeStatus.CONNECTED and node.identifier not in self.unreachable
+
+    def connected_nodes(self, exclude: wavelink.Node | None = None) -> list[wavelink.Node]:
+        return [
+            node for node in wavelink.Pool.nodes.values()
+            if self.is_healthy(node) and node is not exclude
+        ]
+
+    async def refresh(self) -> None:
+        """Fetch the latest stats of every connected node."""
+        for node in wavelink.Pool.nodes.values():
+            if node.status is not wavelink.NodeStatus.CONNECTED:
+                continue
+            try:
+                self.stats[node.identifier] = await node.fetch_stats()
+            except Exception as e:
+                failures = self.failures[node.identifier] = self.failures.get(node.identifier, 0) + 1
+                logger.warning(f"Could not fetch stats of Lavalink node {node.identifier} ({failures} in a row): {e}")
+                if failures >= self.unreachable_after:
+                    self.stats.pop(node.identifier, None)
+                    self.unreachable.add(node.identifier)
+            else:
+                self.failures.pop(node.identifier, None)
+                self.unreachable.discard(node.identifier)
+
+    def ranked_nodes(self, exclude: wavelink.Node | None = None) -> list[wavelink.Node]:
+        """Connected nodes, least loaded first."""
+        return sorted(self.connected_nodes(exclude), key=lambda node: node_penalty(node, self.stats.get(node.identifier)))
+
+    def best_node(self, exclude: wavelink.Node | None = None) -> wavelink.Node:
+        """Return the connected node with the lowest penalty."""
+        nodes = self.ranked_nodes(exclude)
+        if not nodes:
+            raise wavelink.InvalidNodeException("There are no connected Lavalink nodes.")
+        return nodes[0]
+
+    async def connect(self, channel: discord.VoiceChannel, cls: type[wavelink.Player] = wavelink.Player) -> wavelink.Player:
+        """Connect to a voice channel with a player placed on the least loaded node."""
+        node = self.best_node()
+        return await channel.connect(cls = functools.partial(cls, nodes = [node]))
+
+    async def failover(self, node: wavelink.Node, players: list[wavelink.Player]) -> None:
+        """Move players off a node that went down, resuming their tracks at the current position."""
+        for player in players:
+            try:
+                target = self.best_node(exclude = node)
+            except wavelink.InvalidNodeException:
+                logger.error(f"No healthy Lavalink node to move {len(players)} players to")
+                return
+
+            try:
+                await player.switch_node(target)
+                logger.info(f"Moved player of guild {player.guild.id} from node {node.identifier} to {target.identifier}")
+            except Exception as e:
+                logger.error(f"Could not move player of guild {player.guild.id} to node {target.identifier}: {e}")
+
+    async def check_nodes(self) -> None:
+        """Move the players of any node that is down."""
+        for node in wavelink.Pool.nodes.values():
+            if not self.is_healthy(node) and node.players:
+                await self.failover(node, list(node.players.values()))
+
+balancer = NodeBalancer(settings.LAVALINK_UNREACHABLE_AFTER)
@@ -1,8 +1,19 @@
+import abc
 import logging
+import math
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Hashable
+
 import discord 
 from discord.ext import commands
 import wavelink
 import settings
+from utils.history import history
+from utils.playlists import PlaylistRepository
+from utils.tracks import display_info, entry_to_track
+
+if TYPE_CHECKING:
+    from utils.player import MusicPlayer
 
 logger = settings.logging.getLogger("bot")
 
@@ -10,6 +21,14 @@ def format_duration(duration: int) -> str:
     minutes, seconds = divmod(duration // 1000, 60)
     return f"{minutes}:{seconds:02d}"  
 
+def describe_entry(entry: dict) -> str:
+    """Description of a playlist entry, rendered from its track info."""
+    info = entry.get("info")
+    if info:
+        return f"By {info['author']} | Duration: {format_duration(info['length'])}"
+    # Entries saved before tracks were stored only have their description
+    return entry.get("description", "")
+
 def create_green_embed(*, title: str = "", description: str = "") -> discord.Embed:
     embed: discord.Embed = discord.Embed(
         color=discord.Color.dark_green(),
@@ -24,90 +43,176 @@ def create_red_embed(*, title: str = "", description: str = "") -> discord.Embed
         description=description)
     return embed
 
+class PageSource(abc.ABC):
+    """Renders the items of one page at a time, reading the underlying data live."""
+    title: str
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def version(self) -> Hashable:
+        """Changes whenever the rendered pages would change, so cached pages can be told apart."""
+
+    def header(self) -> str:
+        return ""
+
+    @abc.abstractmethod
+    def fields(self, start: int, stop: int) -> list[tuple[str, str]]:
+        """Name and value of the fields for the items in [start, stop)."""
+
+class QueuePageSource(PageSource):
+    """Pages of a player's live queue. Items are numbered like the positions `.jump` and `.remove` accept."""
+
+    def __init__(self, player: "MusicPlayer", title: str = "Current Queue") -> None:
+        self.player = player
+        self.title = title
+
+    def __len__(self) -> int:
+        return len(self.player.queue)
+
+    def version(self) -> Hashable:
+        current = self.player.current
+        return self.player.queue.version, current.encoded if current else None
+
+    def header(self) -> str:
+        current = self.player.current
+        if not current:
+            return ""
+        info = display_info(current)
+        return f"**Now Playing: {info['title']}**\nBy {info['author']} | Duration: {format_duration(current.length)}"
+
+    def fields(self, start: int, stop: int) -> list[tuple[str, str]]:
+        return [
+            (track.title, f"By {track.author} | Duration: {format_duration(track.length)}")
+            for track in self.player.queue[start:stop]
+        ]
+
+class PlaylistPageSource(PageSource):
+    """Pages of a saved playlist's entries."""
+
+    def __init__(self, playlists: PlaylistRepository, guild_id: int | str, title: str, entries: list[dict]) -> None:
+        self.playlists = playlists
+        self.guild_id = guild_id
+        self.title = title
+        self.entries = entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def version(self) -> Hashable:
+        return self.playlists.version(self.guild_id, self.title)
+
+    def fields(self, start: int, stop: int) -> list[tuple[str, str]]:
+        return [(entry["title"], describe_entry(entry)) for entry in self.entries[start:stop]]
+
+class HistoryPageSource(PageSource):
+    """Pages of a guild's play history, most recent first."""
+
+    def __init__(self, guild_id: int, title: str = "Recently Played") -> None:
+        self.guild_id = guild_id
+        self.title = title
+
+    def __len__(self) -> int:
+        ring = history.ring(self.guild_id)
+        return len(ring) if ring else 0
+
+    def version(self) -> Hashable:
+        ring = history.ring(self.guild_id)
+        return ring.recorded if ring else 0
+
+    def fields(self, start: int, stop: int) -> list[tuple[str, str]]:
+        ring = history.ring(self.guild_id)
+        if not ring:
+            return []
+
+        fields = []
+        for i in range(start, min(stop, len(ring))):
+            entry, played_at, _ = ring.get(i)
+            info = display_info(entry_to_track(entry))
+            fields.append((info["title"], f"By {info['author']} | Played <t:{int(played_at)}:R>"))
+        return fields
+
 class PaginationView(discord.ui.View):
-    player: wavelink.Player
+    source: PageSource
     current_page: int = 1
     separator: int = 10
-    playlist_title: str
-    titles: list
-    descriptions: list
+    # Rendered pages kept per view, keyed by page and source version
+    cache_size: int = 8
+    pages: OrderedDict
 
-    def __init__(self, playlist_title: str, titles: list, descriptions: list):
+    def __init__(self, source: PageSource):
         super().__init__()
-        self.playlist_title = playlist_title
-        self.titles = titles
-        self.descriptions = descriptions
-    
+        self.source = source
+        self.pages = OrderedDict()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, math.ceil(len(self.source) / self.separator))
+
     async def send(self, ctx: commands.Context):
-        self.message = await ctx.send(view=self)
-        await self.update_message(self.titles[:self.separator], self.descriptions[:self.separator])
+        self.update_buttons()
+        self.message = await ctx.send(embed=self.get_page(self.current_page), view=self)
 
-    def create_embed(self, titles, descriptions) -> discord.Embed:
-        embed = discord.Embed(color=discord.Color.blurple(), title=f"{self.playlist_title}:")
-        for index, (title, description) in enumerate(zip(titles, descriptions), start=1):
-            i = index + 10 * (self.current_page - 1) 
+    def create_embed(self, page: int) -> discord.Embed:
+        embed = discord.Embed(color=discord.Color.blurple(), title=f"{self.source.title}:", description=self.source.header())
+        from_item = (page - 1) * self.separator # Number of the first item of the page
+        for i, (title, description) in enumerate(self.source.fields(from_item, from_item + self.separator), start=from_item + 1):
             embed.add_field(name=f"{i}.  {title}", value=f"{description}", inline=False)
+        embed.set_footer(text=f"Page {page}/{self.page_count}")
         return embed
-    
-    async def update_message(self, titles, descriptions) -> None:
-        self.update_buttons()
-        await self.message.edit(embed=self.create_embed(titles, descriptions), view=self)
 
-    def update_buttons(self) -> None:
-        if self.current_page == 1:
-            self.first_page_button.disabled = True
-            self.prev_button.disabled = True
+    def get_page(self, page: int) -> discord.Embed:
+        key = (page, self.source.version())
+        embed = self.pages.get(key)
+        if embed is None:
+            embed = self.pages[key] = self.create_embed(page)
+            if len(self.pages) > self.cache_size:
+                self.pages.popitem(last=False)
         else:
-            self.first_page_button.disabled = False
-            self.prev_button.disabled = False
+            self.pages.move_to_end(key)
+        return embed
 
-        if self.current_page == int(len(self.titles) / self.separator) or len(self.titles) <= 10:
-            self.next_button.disabled = True
-            self.last_page_button.disabled = True
-        else:
-            self.next_button.disabled = False
-            self.last_page_button.disabled = False
+    async def show_page(self, page: int) -> None:
+        # The source may have shrunk since the buttons were last updated
+        self.current_page = min(max(page, 1), self.page_count)
+        self.update_buttons()
+        await self.message.edit(embed=self.get_page(self.current_page), view=self)
+
+    def update_buttons(self) -> None:
+        self.first_page_button.disabled = self.prev_button.disabled = self.current_page <= 1
+        self.next_button.disabled = self.last_page_button.disabled = self.current_page >= self.page_count
 
     @discord.ui.button(label="|<", style=discord.ButtonStyle.primary)
     async def first_page_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
         await interaction.response.defer()
-        self.current_page = 1
-        until_item = self.current_page * self.separator # Number of the final item on the page
-        await self.update_message(self.titles[:until_item], self.descriptions[:until_item])
+        await self.show_page(1)
 
     @discord.ui.button(label="<", style=discord.ButtonStyle.primary)
     async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
         await interaction.response.defer()
-        self.current_page -= 1
-        until_item = self.current_page * self.separator # Number of the final item on the page
-        from_item = until_item - self.separator # Number of the first item of the page
-        await self.update_message(self.titles[from_item:until_item], self.descriptions[from_item:until_item])
+        await self.show_page(self.current_page - 1)
 
     @discord.ui.button(label=">", style=discord.ButtonStyle.primary)
     async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
         await interaction.response.defer()
-        self.current_page += 1
-        until_item = self.current_page * self.separator # Number of the final item on the page
-        from_item = until_item - self.separator # Number of the first item of the page
-        await self.update_message(self.titles[from_item:until_item], self.descriptions[from_item:until_item])
+        await self.show_page(self.current_page + 1)
 
     @discord.ui.button(label=">|", style=discord.ButtonStyle.primary)
     async def last_page_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
         await interaction.response.defer()
-        self.current_page = int(len(self.titles) / self.separator)
-        until_item = self.current_page * self.separator # Number of the final item on the page
-        from_item = until_item - self.separator # Number of the first item of the page
-        await self.update_message(self.titles[from_item:], self.descriptions[from_item:])
+        await self.show_page(self.page_count)
 
 class ConfirmationView(discord.ui.View):
     ctx: commands.Context
     player: wavelink.Player
     playlist_title: str
-    playlists: list
+    playlists: PlaylistRepository
     guild_id: str
     confirmation_received: bool
 
-    def __init__(self, ctx: commands.Context, playlist_title: str, playlists: list, timeout: float = 20.0):
+    def __init__(self, ctx: commands.Context, playlist_title: str, playlists: PlaylistRepository, timeout: float = 20.0):
         super().__init__(timeout=timeout)
         self.ctx = ctx
         self.playlist_title = playlist_title
@@ -125,9 +230,7 @@ class ConfirmationView(discord.ui.View):
         await self.update_buttons()
 
     async def remove_playlist(self) -> None:
-        if self.guild_id in self.playlists and self.playlist_title in self.playlists[self.guild_id]:
-            self.playlists[self.guild_id].pop(self.playlist_title)
-            settings.save_playlists(self.playlists)
+        if await self.playlists.delete(self.guild_id, self.playlist_title):
 
             embed = create_green_embed(
                 description=f"Playlist **{self.playlist_title}** has been removed."
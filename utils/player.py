@@ -0,0 +1,85 @@
+import settings
+from utils.circuit import lavalink
+from utils.queue import IndexedQueue
+from utils.prefetch import Prefetcher
+
+import discord
+import wavelink
+
+class GuildSession:
+    """Per-guild playback state, attached to the guild's player."""
+    __slots__ = ("loop", "home", "volume", "history_session", "rewound", "settings", "loaders", "idle")
+
+    loop: bool
+    home: discord.abc.Messageable | None
+    volume: int
+    # Number of this player's session in the guild's play history, assigned when its first track finishes
+    history_session: int | None
+    # Encoded track `.previous` interrupted and put back in the queue, so it isn't recorded as played
+    rewound: str | None
+    settings: dict
+    loaders: set
+    # Why and since when (monotonic) the player has been idle
+    idle: tuple[str, float] | None
+
+    def __init__(self) -> None:
+        self.loop = False
+        self.home = None
+        self.volume = settings.DEFAULT_VOLUME
+        self.history_session = None
+        self.rewound = None
+        self.settings = {}
+        self.loaders = set()
+        self.idle = None
+
+class MusicPlayer(wavelink.Player):
+    """Player carrying its guild's session, so guilds never share playback state."""
+    session: GuildSession
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.session = GuildSession()
+        self.queue: IndexedQueue = IndexedQueue()
+        self.prefetcher = Prefetcher(self, settings.PREFETCH_DEPTH)
+        self.queue.listener = self.prefetcher.schedule
+        # Where the track was when the player disconnected, wavelink reports 0 once it has
+        self.last_position = 0
+
+    async def play(self, track: wavelink.Playable, **kwargs) -> wavelink.Playable:
+        # Skips the mirror lookup Lavalink would otherwise do when the track starts
+        queued, track = track, self.prefetcher.take(track)
+        play = super().play
+        state = self._current, self._original, self._previous, self.queue._loaded, self._volume
+        try:
+            track = await lavalink.play(self, lambda: play(track, **kwargs))
+        except Exception:
+            # wavelink only rolls back on Lavalink errors, a timed out play is left looking like it's playing
+            self._current, self._original, self._previous, self.queue._loaded, self._volume = state
+            # Played next instead of lost, and the next .play starts it if nothing is playing
+            self.queue.put_at(0, queued)
+            raise
+        # The guild's history is kept by utils.history, only autoplay's recent tracks are needed here
+        while len(self.queue.history) > settings.HISTORY_SIZE:
+            self.queue.history.delete(0)
+        return track
+
+    async def skip(self, **kwargs) -> wavelink.Playable | None:
+        skip = super().skip
+        # A skip Lavalink applied before timing out would skip the next track too if retried
+        return await lavalink.play(self, lambda: skip(**kwargs), retry = False)
+
+    async def pause(self, value: bool, /) -> None:
+        pause = super().pause
+        await lavalink.play(self, lambda: pause(value))
+
+    def cancel_loaders(self) -> None:
+        """Cancel every playlist still being loaded into the queue."""
+        for task in self.session.loaders:
+            task.cancel()
+
+    async def disconnect(self, **kwargs) -> None:
+        if self.connected:
+            self.last_position = self.position
+        self.cancel_loaders()
+        self.prefetcher.cancel()
+        await super().disconnect(**kwargs)
@@ -0,0 +1,225 @@
+import asyncio
+
+import settings
+from utils.search_index import TrigramIndex
+from utils.storage import PlaylistStore, track_table
+
+logger = settings.logging.getLogger(__name__)
+
+def entry_author(entry: dict) -> str:
+    # Entries saved before track info was stored only have a title
+    return entry.get("info", {}).get("author") or ""
+
+class PlaylistIndex:
+    """Title/author index over every playlist of a guild.
+
+    Entries are keyed by identity, as the same entry object can be in several
+    playlists. Positions are looked up per playlist and cached until it changes.
+    """
+
+    def __init__(self, playlists: dict[str, list[dict]]) -> None:
+        self.playlists = playlists
+        self.index = TrigramIndex()
+        self.entries: dict[int, dict] = {}
+        self.positions: dict[str, dict[int, list[int]]] = {}
+        for name, playlist in playlists.items():
+            self.add(name, playlist)
+
+    def add(self, name: str, entries: list[dict]) -> None:
+        for entry in entries:
+            self.entries[id(entry)] = entry
+            self.index.add(id(entry), entry.get("title") or "", entry_author(entry))
+        self.positions.pop(name, None)
+
+    def discard(self, name: str, entries: list[dict]) -> None:
+        for entry in entries:
+            self.index.discard(id(entry))
+            if id(entry) not in self.index:
+                self.entries.pop(id(entry), None)
+        self.positions.pop(name, None)
+
+    def refresh(self, entries: list[dict]) -> None:
+        """Index the new title and artist of entries changed in place, in every playlist sharing them."""
+        for entry in entries:
+            self.index.update(id(entry), entry.get("title") or "", entry_author(entry))
+
+    def moved(self, *names: str) -> None:
+        """Forget the cached positions of playlists that were renamed or reordered."""
+        for name in names:
+            self.positions.pop(name, None)
+
+    def locate(self, name: str) -> dict[int, list[int]]:
+        """Positions of every entry of a playlist, by entry key."""
+        if name not in self.positions:
+            positions: dict[int, list[int]] = {}
+            for i, entry in enumerate(self.playlists.get(name, [])):
+                positions.setdefault(id(entry), []).append(i)
+            self.positions[name] = positions
+        return self.positions[name]
+
+    def find(self, query: str, name: str | None = None, fuzzy: bool = True) -> list[tuple[str, int, dict]]:
+        """Playlist name, position and entry of every song matching the query.
+
+        Songs whose title or artist contains the query come first, by playlist and
+        position. Without any, and if `fuzzy`, the closest titles and artists follow, best first.
+        """
+        names = [name] if name is not None else sorted(self.playlists)
+        scores = dict.fromkeys(self.index.search(query), 1.0)
+        if not scores and fuzzy:
+            scores = {key: score for score, key in self.index.similar(query)}
+        if not scores:
+            return []
+
+        results = []
+        for playlist_name in names:
+            positions = self.locate(playlist_name)
+            for key in scores.keys() & positions.keys():
+                entry = self.entries[key]
+                results.extend((-scores[key], playlist_name, position, entry) for position in positions[key])
+        results.sort(key = lambda result: result[:3])
+        return [(playlist_name, position, entry) for _, playlist_name, position, entry in results]
+
+class PlaylistRepository:
+    """The single in-memory copy of every guild's playlists.
+
+    Owned by the bot so it survives cog reloads. A guild's playlists are loaded
+    from the store the first time they are needed, every change goes through
+    this class so the store only has to persist what changed.
+    """
+    store: PlaylistStore
+    guilds: dict[str, dict[str, list[dict]]]
+
+    def __init__(self, store: PlaylistStore) -> None:
+        self.store = store
+        self.guilds = {}
+        self.loading: dict[str, asyncio.Task] = {}
+        self.opened: asyncio.Task | None = None
+        # Built on a guild's first search and kept up to date by every change after it
+        self.indexes: dict[str, PlaylistIndex] = {}
+        # Number of the last change of each playlist, out of every change made
+        self.changes = 0
+        self.versions: dict[tuple[str, str], int] = {}
+
+    def changed(self, guild_id: str, name: str) -> None:
+        self.changes += 1
+        self.versions[(guild_id, name)] = self.changes
+
+    def version(self, guild_id: int | str, name: str) -> int:
+        """Changes whenever the playlist does, for telling rendered pages apart."""
+        return self.versions.get((str(guild_id), name), 0)
+
+    async def get_guild(self, guild_id: int | str) -> dict[str, list[dict]]:
+        """Return the playlists of a guild, loading them on first use."""
+        guild_id = str(guild_id)
+        if guild_id in self.guilds:
+            return self.guilds[guild_id]
+
+        # Concurrent commands in a guild that isn't loaded yet share a single load
+        if guild_id not in self.loading:
+            self.loading[guild_id] = asyncio.create_task(self._load_guild(guild_id))
+        return await asyncio.shield(self.loading[guild_id])
+
+    async def _load_guild(self, guild_id: str) -> dict[str, list[dict]]:
+        try:
+            if not self.opened:
+                self.opened = asyncio.create_task(self.store.open())
+            opened = self.opened
+            try:
+                await asyncio.shield(opened)
+            except Exception:
+                # The next load tries to open the store again instead of failing the same way forever
+                if self.opened is opened and opened.done():
+                    self.opened = None
+                raise
+
+            self.guilds[guild_id] = await self.store.load_guild(guild_id)
+            return self.guilds[guild_id]
+        finally:
+            del self.loading[guild_id]
+
+    async def names(self, guild_id: int | str) -> list[str]:
+        """Return the names of a guild's playlists."""
+        return [*(await self.get_guild(guild_id))]
+
+    async def size(self, guild_id: int | str) -> int:
+        """Return the number of entries across all of a guild's playlists."""
+        return sum(len(playlist) for playlist in (await self.get_guild(guild_id)).values())
+
+    async def find(self, guild_id: int | str, query: str, name: str | None = None, fuzzy: bool = True) -> list[tuple[str, int, dict]]:
+        """Search songs by title or artist in one or all of a guild's playlists. See PlaylistIndex.find."""
+        playlists = await self.get_guild(guild_id)
+        guild_id = str(guild_id)
+        if guild_id not in self.indexes:
+            self.indexes[guild_id] = PlaylistIndex(playlists)
+        return self.indexes[guild_id].find(query, name, fuzzy)
+
+    async def get(self, guild_id: int | str, name: str) -> list[dict] | None:
+        """Return the entries of a playlist, or None if it doesn't exist."""
+        return (await self.get_guild(guild_id)).get(name)
+
+    async def add(self, guild_id: int | str, name: str, entries: list[dict]) -> list[dict]:
+        """Append entries to a playlist, creating it if needed. Returns the playlist."""
+        playlists = await self.get_guild(guild_id)
+        playlist = playlists.setdefault(name, [])
+        # Tracks already saved anywhere are shared instead of stored again
+        entries = [track_table.intern(entry) for entry in entries]
+        playlist.extend(entries)
+        self.changed(str(guild_id), name)
+        if index := self.indexes.get(str(guild_id)):
+            index.add(name, entries)
+        await self.store.append_entries(str(guild_id), name, entries)
+        return playlist
+
+    async def remove(self, guild_id: int | str, name: str, index: int) -> dict:
+        """Remove and return the entry at `index` of a playlist."""
+        playlists = await self.get_guild(guild_id)
+        entry = playlists[name].pop(index)
+        self.changed(str(guild_id), name)
+        if playlist_index := self.indexes.get(str(guild_id)):
+            playlist_index.discard(name, [entry])
+        await self.store.remove_entry(str(guild_id), name, index)
+        return entry
+
+    async def delete(self, guild_id: int | str, name: str) -> bool:
+        """Delete a playlist. Returns False if it doesn't exist."""
+        playlists = await self.get_guild(guild_id)
+        if name not in playlists:
+            return False
+        playlist = playlists.pop(name)
+        self.versions.pop((str(guild_id), name), None)
+        if index := self.indexes.get(str(guild_id)):
+            index.discard(name, playlist)
+        await self.store.delete_playlist(str(guild_id), name)
+        return True
+
+    async def rename(self, guild_id: int | str, name: str, new_name: str) -> bool:
+        """Rename a playlist. Returns False if it doesn't exist or the new name is taken."""
+        playlists = await self.get_guild(guild_id)
+        if name not in playlists or new_name in playlists:
+            return False
+        playlists[new_name] = playlists.pop(name)
+        self.versions.pop((str(guild_id), name), None)
+        self.changed(str(guild_id), new_name)
+        if index := self.indexes.get(str(guild_id)):
+            index.moved(name, new_name)
+        await self.store.rename_playlist(str(guild_id), name, new_name)
+        return True
+
+    async def update(self, guild_id: int | str, name: str) -> None:
+        """Persist entries of a playlist that were changed in place."""
+        playlist = await self.get(guild_id, name)
+        if playlist is not None:
+            self.changed(str(guild_id), name)
+            # Upgraded entries may have gained an artist
+            if index := self.indexes.get(str(guild_id)):
+                index.refresh(playlist)
+            await self.store.save_playlist(str(guild_id), name, playlist)
+
+    async def flush(self) -> None:
+        """Write any pending changes to the store."""
+        if self.opened:
+            await self.store.flush()
+
+    async def close(self) -> None:
+        if self.opened:
+            await self.store.close()
@@ -0,0 +1,99 @@
+import asyncio
+from typing import TYPE_CHECKING
+
+import settings
+from utils.tracks import display_info, search_cache
+
+import wavelink
+
+if TYPE_CHECKING:
+    from utils.player import MusicPlayer
+
+logger = settings.logging.getLogger(__name__)
+
+# Sources whose tracks Lavalink can't stream directly, and resolves to a mirror when they start playing
+MIRRORED_SOURCES = {"spotify", "applemusic"}
+
+async def resolve_mirror(track: wavelink.Playable) -> wavelink.Playable | None:
+    """Find a directly playable track for a mirrored one, the same way Lavalink would when playing it."""
+    queries = [f'"{track.isrc}"'] if track.isrc else []
+    queries.append(f"{track.title} {track.author}")
+
+    for query in queries:
+        results: wavelink.Search = await search_cache.get(query, wavelink.TrackSource.YouTubeMusic)
+        if results and not isinstance(results, wavelink.Playlist):
+            mirror = results[0]
+            break
+    else:
+        return None
+
+    # A copy, as search results are shared through the cache. The original's info travels
+    # with the mirror as Lavalink userData, so it's still what the track start event shows
+    data = dict(mirror.raw_data)
+    data["userData"] = display_info(track)
+    return wavelink.Playable(data)
+
+class Prefetcher:
+    """Resolves the next few queued tracks of a player before they are played.
+
+    The window of upcoming tracks is checked whenever the queue changes. Appending
+    past the window leaves the running prefetch alone, while anything that changes
+    the window (a track starting, shuffle, jump, remove) cancels it and starts over.
+    """
+
+    def __init__(self, player: "MusicPlayer", depth: int) -> None:
+        self.player = player
+        self.depth = depth
+        # Mirrors by the encoded data of the queued track they replace
+        self.resolved: dict[str, wavelink.Playable] = {}
+        self.window: tuple[str, ...] = ()
+        self.task: asyncio.Task | None = None
+        self.scheduled = False
+
+    def schedule(self) -> None:
+        """Check the window once the current batch of queue changes is done."""
+        if self.scheduled or self.depth <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.scheduled = True
+        loop.call_soon(self.refresh)
+
+    def refresh(self) -> None:
+        self.scheduled = False
+        upcoming = [track for track in self.player.queue[:self.depth] if track.source in MIRRORED_SOURCES]
+        window = tuple(track.encoded for track in upcoming)
+        if window == self.window:
+            return
+
+        self.cancel()
+        self.window = window
+        self.resolved = {key: track for key, track in self.resolved.items() if key in window}
+        if upcoming:
+            self.task = asyncio.create_task(self.run(upcoming))
+
+    async def run(self, upcoming: list[wavelink.Playable]) -> None:
+        for track in upcoming:
+            if track.encoded in self.resolved:
+                continue
+            try:
+                mirror = await resolve_mirror(track)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Could not prefetch {track.title}: {e}")
+                continue
+            if mirror:
+                self.resolved[track.encoded] = mirror
+
+    def take(self, track: wavelink.Playable) -> wavelink.Playable:
+        """The prefetched mirror of a track about to be played, or the track itself."""
+        return self.resolved.pop(track.encoded, track)
+
+    def cancel(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.window = ()
@@ -0,0 +1,186 @@
+import random
+from typing import Callable
+
+from utils.search_index import TrigramIndex
+
+import wavelink
+
+class IndexedList(list):
+    """List of queued tracks that reports every insertion and removal to its queue.
+
+    wavelink.Queue mutates its `_items` list directly, so hooking the list keeps
+    the index correct whichever queue method is used.
+    """
+
+    def __init__(self, queue: "IndexedQueue", items=()) -> None:
+        super().__init__(items)
+        self.queue = queue
+        for track in self:
+            queue._added(track)
+
+    def append(self, track) -> None:
+        super().append(track)
+        self.queue._added(track)
+
+    def extend(self, tracks) -> None:
+        tracks = list(tracks)
+        super().extend(tracks)
+        for track in tracks:
+            self.queue._added(track)
+
+    def __iadd__(self, tracks):
+        self.extend(tracks)
+        return self
+
+    def insert(self, index, track) -> None:
+        super().insert(index, track)
+        self.queue._added(track)
+
+    def pop(self, index=-1):
+        track = super().pop(index)
+        self.queue._removed(track)
+        return track
+
+    def remove(self, track) -> None:
+        # The removed item may be an equal but different object, so report the one actually removed
+        del self[self.index(track)]
+
+    def clear(self) -> None:
+        for track in self:
+            self.queue._removed(track)
+        super().clear()
+
+    def __setitem__(self, index, value) -> None:
+        old = self[index]
+        super().__setitem__(index, value)
+        if isinstance(index, slice):
+            for track in value:
+                self.queue._added(track)
+            for track in old:
+                self.queue._removed(track)
+        else:
+            self.queue._added(value)
+            self.queue._removed(old)
+
+    def __delitem__(self, index) -> None:
+        old = self[index]
+        super().__delitem__(index)
+        for track in (old if isinstance(index, slice) else [old]):
+            self.queue._removed(track)
+
+    def sort(self, *args, **kwargs) -> None:
+        super().sort(*args, **kwargs)
+        self.queue._moved()
+
+    def reverse(self) -> None:
+        super().reverse()
+        self.queue._moved()
+
+class IndexedQueue(wavelink.Queue):
+    """Queue keeping a title/author trigram index, for fast lookups in large queues.
+
+    `version` changes on every change to the queue, so callers can tell when
+    anything derived from it (positions, rendered pages, prefetched tracks) is stale.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.index = TrigramIndex()
+        self.tracks: dict[int, wavelink.Playable] = {}
+        self.version = 0
+        # Called after every change, e.g. to refresh anything prefetched from the head of the queue
+        self.listener: Callable[[], None] | None = None
+        self._positions: dict[int, int] = {}
+        self._positions_version = -1
+        super().__init__(*args, **kwargs)
+
+    @property
+    def _items(self) -> IndexedList:
+        return self.__items
+
+    @_items.setter
+    def _items(self, items: list) -> None:
+        if hasattr(self, "_IndexedQueue__items"):
+            self.__items.clear()
+        self.__items = IndexedList(self, items)
+
+    def _added(self, track: wavelink.Playable) -> None:
+        self.tracks[id(track)] = track
+        self.index.add(id(track), track.title, track.author)
+        self._changed()
+
+    def _removed(self, track: wavelink.Playable) -> None:
+        self.index.discard(id(track))
+        if id(track) not in self.index:
+            del self.tracks[id(track)]
+        self._changed()
+
+    def _moved(self) -> None:
+        self._changed()
+
+    def _changed(self) -> None:
+        self.version += 1
+        if self.listener:
+            self.listener()
+
+    def shuffle(self) -> None:
+        # Shuffling only reorders, so bypass the per item index updates
+        items = list(self._items)
+        random.shuffle(items)
+        list.__setitem__(self._items, slice(None), items)
+        self._moved()
+
+    def position(self, track: wavelink.Playable) -> int:
+        """Index of the first occurrence of a queued track."""
+        if self._positions_version != self.version:
+            self._positions = {}
+            for i, item in enumerate(self._items):
+                self._positions.setdefault(id(item), i)
+            self._positions_version = self.version
+        return self._positions[id(track)]
+
+    def matches(self, query: str, limit: int = 5) -> list[tuple[int, wavelink.Playable]]:
+        """Queued tracks matching the query, best match first.
+
+        Tracks whose title contains the query come first, in queue order, followed
+        by fuzzy matches on title and author ranked by similarity.
+        """
+        exact = sorted(self.position(self.tracks[key]) for key in self.index.search(query, fields=(0,)))
+        results = [(i, self._items[i]) for i in exact[:limit]]
+
+        if len(results) < limit:
+            seen = {id(track) for _, track in results}
+            ranked = self.index.similar(query)
+            # Equal scores keep queue order
+            ranked.sort(key=lambda item: (-item[0], self.position(self.tracks[item[1]])))
+            for _, key in ranked:
+                if key not in seen:
+                    results.append((self.position(self.tracks[key]), self.tracks[key]))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def find(self, query: str) -> tuple[int, wavelink.Playable] | None:
+        """Find a queued track by title or by its 1-based position.
+
+        An exact title wins over a position, so a song titled "1999" can be found;
+        "#3" is always the third track. Returns its index in the queue and the
+        track, or None if nothing matches.
+        """
+        if not query.startswith("#"):
+            titled = [
+                self.position(self.tracks[key]) for key in self.index.search(query, fields=(0,))
+                if self.tracks[key].title.lower() == query.lower()
+            ]
+            if titled:
+                return min(titled), self._items[min(titled)]
+
+        position = query.removeprefix("#")
+        if position.isdigit():
+            if 1 <= int(position) <= len(self):
+                index = int(position) - 1
+                return index, self._items[index]
+            if query.startswith("#"):
+                return None
+
+        results = self.matches(query, limit=1)
+        return results[0] if results else None
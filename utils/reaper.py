@@ -0,0 +1,89 @@
+import time
+
+import settings
+from utils.dispatch import dispatcher
+from utils.lanes import LaneBusy, lanes
+from utils.pagination import create_red_embed
+from utils.player import MusicPlayer
+
+import discord
+
+logger = settings.logging.getLogger(__name__)
+
+FAREWELLS = {
+    "alone": "Left the voice channel as nobody was listening.",
+    "paused": "Left the voice channel as the Player was paused for too long.",
+    "finished": "Left the voice channel as there was nothing left to play."
+}
+
+def idle_reason(player: MusicPlayer) -> str | None:
+    """Why the player is idle, or None if it is in use."""
+    if not any(not member.bot for member in player.channel.members):
+        return "alone"
+    if player.paused and player.current:
+        return "paused"
+    if not player.playing and not player.queue and not player.session.loaders:
+        return "finished"
+    return None
+
+class IdleReaper:
+    """Disconnects players that stayed idle longer than their policy allows.
+
+    One periodic sweep covers every guild. The first sweep that sees a player idle
+    records why and when; the player is only reaped if it is still idle for the
+    same reason once that reason's timeout has passed.
+    """
+
+    def __init__(self, timeouts: dict[str, float], farewell: bool = True) -> None:
+        self.timeouts = timeouts
+        self.farewell = farewell
+        self.reaped = 0
+
+    async def sweep(self, players: list) -> None:
+        now = time.monotonic()
+        for player in players:
+            if not isinstance(player, MusicPlayer) or not player.connected:
+                continue
+
+            reason = idle_reason(player)
+            if reason is None or not self.timeouts.get(reason):
+                player.session.idle = None
+                continue
+
+            if not player.session.idle or player.session.idle[0] != reason:
+                player.session.idle = (reason, now)
+                continue
+
+            if now - player.session.idle[1] >= self.timeouts[reason]:
+                try:
+                    # Never disconnects a player under a running command, busy guilds are checked on the next sweep
+                    async with lanes.hold(player.guild.id, wait = False):
+                        if player.connected and idle_reason(player) == reason:
+                            await self.reap(player, reason)
+                except LaneBusy:
+                    continue
+                except Exception as e:
+                    logger.warning(f"Could not disconnect the idle player of guild {player.guild.id}: {e}")
+
+    async def reap(self, player: MusicPlayer, reason: str) -> None:
+        home = player.session.home
+        await player.disconnect()
+        self.reaped += 1
+        logger.info(f"Disconnected idle player of guild {player.guild.id} | Reason: {reason}")
+
+        dispatcher.forget(home, "now_playing")
+        if self.farewell:
+            embed: discord.Embed = create_red_embed(description=FAREWELLS[reason])
+            dispatcher.notify(home, "farewell", embed=embed)
+
+    def stats(self) -> dict:
+        return {"reaped": self.reaped}
+
+reaper = IdleReaper(
+    {
+        "alone": settings.IDLE_ALONE_TIMEOUT,
+        "paused": settings.IDLE_PAUSED_TIMEOUT,
+        "finished": settings.IDLE_FINISHED_TIMEOUT
+    },
+    farewell = settings.IDLE_FAREWELL
+)
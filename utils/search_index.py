@@ -0,0 +1,113 @@
+from collections import Counter
+from typing import Hashable, Iterable
+
+def normalize(text: str) -> str:
+    return text.lower()
+
+def trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class TrigramIndex:
+    """Case-insensitive substring and fuzzy search over short text fields.
+
+    Each key is indexed with one or more fields (e.g. title and author), lowercased
+    once when added. Substring lookups intersect the posting sets of the query's
+    trigrams and only check the remaining candidates, so no text is lowercased or
+    scanned per lookup. Adding the same key again only counts another reference.
+    """
+
+    def __init__(self) -> None:
+        self.postings: dict[str, set[Hashable]] = {}
+        self.fields: dict[Hashable, tuple[str, ...]] = {}
+        self.refs: dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.fields
+
+    def add(self, key: Hashable, *fields: str) -> None:
+        if key in self.refs:
+            self.refs[key] += 1
+            return
+
+        self.refs[key] = 1
+        normalized = tuple(normalize(field) for field in fields)
+        self.fields[key] = normalized
+        for gram in set().union(*(trigrams(field) for field in normalized)):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def discard(self, key: Hashable) -> None:
+        count = self.refs.get(key)
+        if not count:
+            return
+        if count > 1:
+            self.refs[key] = count - 1
+            return
+
+        del self.refs[key]
+        for gram in set().union(*(trigrams(field) for field in self.fields.pop(key))):
+            keys = self.postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self.postings[gram]
+
+    def update(self, key: Hashable, *fields: str) -> None:
+        """Index a key with new fields, keeping its references."""
+        old = self.fields.get(key)
+        normalized = tuple(normalize(field) for field in fields)
+        if old is None or old == normalized:
+            return
+
+        self.fields[key] = normalized
+        old_grams = set().union(*(trigrams(field) for field in old))
+        new_grams = set().union(*(trigrams(field) for field in normalized))
+        for gram in old_grams - new_grams:
+            keys = self.postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self.postings[gram]
+        for gram in new_grams - old_grams:
+            self.postings.setdefault(gram, set()).add(key)
+
+    def clear(self) -> None:
+        self.postings.clear()
+        self.fields.clear()
+        self.refs.clear()
+
+    def search(self, query: str, fields: Iterable[int] | None = None) -> set[Hashable]:
+        """Return the keys with `query` as a substring of any of the given fields (all fields by default)."""
+        query = normalize(query)
+        grams = trigrams(query)
+
+        if grams:
+            posting_sets = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            candidates = set(posting_sets[0]).intersection(*posting_sets[1:])
+        else:
+            # Queries shorter than a trigram can't use the index
+            candidates = self.fields.keys()
+
+        positions = tuple(fields) if fields is not None else None
+        matches = set()
+        for key in candidates:
+            values = self.fields[key]
+            if positions is not None:
+                values = [values[i] for i in positions]
+            if any(query in value for value in values):
+                matches.add(key)
+        return matches
+
+    def similar(self, query: str, threshold: float = 0.5) -> list[tuple[float, Hashable]]:
+        """Rank keys by the share of the query's trigrams found in their fields, best first."""
+        grams = trigrams(normalize(query))
+        if not grams:
+            return []
+
+        counts: Counter = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+
+        ranked = [(count / len(grams), key) for key, count in counts.items() if count / len(grams) >= threshold]
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked
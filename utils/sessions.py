@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import settings
+from utils.lanes import lanes
+from utils.nodes import balancer
+from utils.player import MusicPlayer
+
+import discord
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+# Sessions are restored once per process, not on every cog reload or node reconnect
+restored = False
+
+def snapshot_player(player: MusicPlayer) -> dict:
+    """Capture everything needed to resume a player without searching again."""
+    session = player.session
+    return {
+        "channel": player.channel.id,
+        "home": session.home.id if session.home else None,
+        "node": player.node.identifier,
+        "current": player.current.raw_data if player.current else None,
+        "position": player.position if player.connected else player.last_position,
+        "paused": player.paused,
+        "volume": player.volume,
+        "loop": session.loop,
+        "queue": [track.raw_data for track in player.queue]
+    }
+
+def take_snapshot(bot: discord.Client) -> dict:
+    return {
+        # Lets nodes resume their Lavalink session when the bot comes back within the resume timeout
+        "nodes": {node.identifier: node.session_id for node in wavelink.Pool.nodes.values() if node.session_id},
+        "players": {
+            str(player.guild.id): snapshot_player(player)
+            for player in bot.voice_clients
+            if isinstance(player, MusicPlayer) and player.connected
+        }
+    }
+
+async def save_snapshot(bot: discord.Client) -> None:
+    # Keep the previous run's snapshot until it has been restored
+    if not restored:
+        return
+
+    # Serialize on the loop, write off it
+    data = json.dumps(take_snapshot(bot))
+    await asyncio.to_thread(settings.write_sessions, data)
+
+def load_snapshot() -> dict:
+    try:
+        return settings.load_sessions()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read the session snapshot: {e}")
+        return {}
+
+def resume_node_sessions(nodes: list[wavelink.Node], snapshot: dict) -> None:
+    """Reuse the Lavalink session ids of the previous run, so nodes keep the players they still hold."""
+    if settings.LAVALINK_RESUME_TIMEOUT <= 0:
+        return
+
+    sessions: dict = snapshot.get("nodes", {})
+    for node in nodes:
+        if node.identifier in sessions:
+            # wavelink sends this as the Session-Id header when connecting
+            node._session_id = sessions[node.identifier]
+
+async def restore_player(bot: discord.Client, guild_id: int, data: dict) -> bool:
+    """Rejoin a guild's voice channel and resume playback from its snapshot."""
+    # Commands sent before the snapshot was restored go first
+    async with lanes.hold(guild_id):
+        return await resume_player(bot, guild_id, data)
+
+async def resume_player(bot: discord.Client, guild_id: int, data: dict) -> bool:
+    guild = bot.get_guild(guild_id)
+    channel = guild.get_channel(data["channel"]) if guild else None
+    if not channel or not any(not member.bot for member in channel.members):
+        return False
+    # A command already started a new player
+    if guild.voice_client:
+        return False
+
+    player: MusicPlayer = await balancer.connect(channel, MusicPlayer)
+    player.session.home = guild.get_channel(data["home"]) if data["home"] else None
+    player.session.loop = data["loop"]
+    player.session.volume = data["volume"]
+    player.autoplay = wavelink.AutoPlayMode.partial
+
+    for track_data in data["queue"]:
+        player.queue.put(wavelink.Playable(track_data))
+
+    if data["current"]:
+        position = data["position"]
+
+        # A resumed Lavalink session knows the exact position the track reached
+        if player.node.identifier == data["node"]:
+            info = await player.node.fetch_player_info(guild_id)
+            if info and info.track and info.track.encoded == data["current"]["encoded"]:
+                position = info.state.position
+
+        await player.play(
+            wavelink.Playable(data["current"]),
+            start = position,
+            volume = data["volume"],
+            paused = data["paused"],
+            add_history = False
+        )
+    elif player.queue:
+        await player.play(player.queue.get(), volume = data["volume"])
+    return True
+
+async def rebuild_players(bot: discord.Client, players: list[wavelink.Player]) -> None:
+    """Reconnect the players a closed node disconnected, resuming them on another node."""
+    for player in players:
+        if not isinstance(player, MusicPlayer) or not player.guild or not player.channel:
+            continue
+
+        guild_id = player.guild.id
+        try:
+            if await restore_player(bot, guild_id, snapshot_player(player)):
+                logger.info(f"Rebuilt player of guild {guild_id} on another node")
+        except Exception as e:
+            logger.error(f"Could not rebuild player of guild {guild_id}: {e}")
+
+async def restore_sessions(bot: discord.Client, snapshot: dict) -> None:
+    """Resume every player saved in the snapshot of the previous run."""
+    global restored
+    if restored:
+        return
+    restored = True
+
+    resumed = 0
+    for guild_id, data in snapshot.get("players", {}).items():
+        try:
+            resumed += await restore_player(bot, int(guild_id), data)
+        except Exception as e:
+            logger.warning(f"Could not restore the player of guild {guild_id}: {e}")
+
+    if resumed:
+        logger.info(f"Restored {resumed} players from the previous session")
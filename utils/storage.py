@@ -0,0 +1,510 @@
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from utils.metrics import metrics
+
+logger = settings.logging.getLogger(__name__)
+
+class TrackEntry(dict):
+    """A playlist entry that can be shared by every playlist containing the same track."""
+    __slots__ = ("__weakref__",)
+
+def track_key(entry: dict) -> str:
+    """Content address of the track of a playlist entry: its url, source id, or a hash of its data."""
+    if entry.get("url"):
+        return entry["url"]
+    info = entry.get("info", {})
+    if info.get("identifier"):
+        return f"{info.get('sourceName')}:{info['identifier']}"
+    return "sha1:" + hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+
+def compact_entry(entry: dict) -> dict:
+    """The entry without anything that can be rendered from its track info."""
+    if "info" not in entry:
+        # Entries saved before tracks were stored only have their description
+        return entry
+    return {key: value for key, value in entry.items() if key != "description"}
+
+class TrackTable:
+    """Interns playlist entries so each track is held in memory once across all guilds.
+
+    Entries are only weakly referenced, a track is dropped once no loaded playlist contains it.
+    """
+
+    def __init__(self) -> None:
+        self.tracks: weakref.WeakValueDictionary[str, TrackEntry] = weakref.WeakValueDictionary()
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def get(self, key: str) -> TrackEntry | None:
+        return self.tracks.get(key)
+
+    def intern(self, entry: dict, key: str | None = None) -> TrackEntry:
+        """Return the shared entry of a track, upgrading it if `entry` has its encoded data and the shared one doesn't."""
+        key = key or track_key(entry)
+        shared = self.tracks.get(key)
+        if shared is None:
+            shared = self.tracks[key] = TrackEntry(compact_entry(entry))
+        elif "encoded" in entry and "encoded" not in shared:
+            shared.update(compact_entry(entry))
+            shared.pop("description", None)
+        return shared
+
+track_table = TrackTable()
+
+def pack_playlists(playlists: dict) -> dict:
+    """Playlists as saved in playlists.json: each track once, and playlists as lists of track keys."""
+    tracks: dict = {}
+    packed: dict = {}
+    for guild_id, guild_playlists in playlists.items():
+        packed[guild_id] = {}
+        for name, entries in guild_playlists.items():
+            keys = packed[guild_id][name] = []
+            for entry in entries:
+                key = track_key(entry)
+                tracks[key] = entry
+                keys.append(key)
+    return {"tracks": tracks, "playlists": packed}
+
+def unpack_playlists(data: dict) -> dict:
+    """Playlists loaded from playlists.json as {guild_id: {name: [entry, ...]}}."""
+    # Files written before tracks were shared hold full entries
+    if "tracks" not in data:
+        return data
+
+    tracks: dict = data["tracks"]
+    return {
+        guild_id: {name: [tracks[key] for key in keys] for name, keys in guild_playlists.items()}
+        for guild_id, guild_playlists in data["playlists"].items()
+    }
+
+def track_rows(entries: list[dict]) -> list[tuple[str, str]]:
+    """Key and serialized data of each entry. Done on the loop, as entries are shared and upgraded in place."""
+    return [(track_key(entry), json.dumps(compact_entry(entry))) for entry in entries]
+
+class PlaylistStore(abc.ABC):
+    """Base class for playlist storage backends.
+
+    Playlists are kept in memory as {guild_id: {playlist_name: [entry, ...]}}, with
+    entries interned in `track_table`, the store is told about each change so it
+    only has to persist what changed.
+    """
+
+    async def open(self) -> None:
+        """Prepare the store before the first playlist is loaded."""
+        pass
+
+    @abc.abstractmethod
+    async def load_guild(self, guild_id: str) -> dict:
+        """Load the playlists of a single guild as {playlist_name: [entry, ...]}."""
+
+    @abc.abstractmethod
+    async def append_entries(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        """Append entries to a playlist, creating it if needed."""
+
+    @abc.abstractmethod
+    async def remove_entry(self, guild_id: str, name: str, index: int) -> None:
+        """Remove the entry at `index` from a playlist."""
+
+    @abc.abstractmethod
+    async def save_playlist(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        """Replace every entry of a playlist."""
+
+    @abc.abstractmethod
+    async def delete_playlist(self, guild_id: str, name: str) -> None:
+        """Delete a playlist and all of its entries."""
+
+    @abc.abstractmethod
+    async def rename_playlist(self, guild_id: str, name: str, new_name: str) -> None:
+        """Rename a playlist, keeping its entries."""
+
+    async def apply_changes(self, changes: list[tuple]) -> None:
+        """Persist several changes at once, in order. Each change is the name of the
+        method that was called ("append_entries", "remove_entry", ...) followed by its arguments."""
+        for method, *args in changes:
+            await getattr(self, method)(*args)
+
+    async def flush(self) -> None:
+        """Write any pending changes."""
+        pass
+
+    async def close(self) -> None:
+        pass
+
+class JsonPlaylistStore(PlaylistStore):
+    """Keeps every playlist in a single JSON file, rewritten on each change."""
+
+    def __init__(self) -> None:
+        self.playlists: dict = {}
+        self.lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        playlists = unpack_playlists(await asyncio.to_thread(settings.load_playlists))
+        self.playlists = {
+            guild_id: {name: [track_table.intern(entry) for entry in entries] for name, entries in guild_playlists.items()}
+            for guild_id, guild_playlists in playlists.items()
+        }
+
+    async def load_guild(self, guild_id: str) -> dict:
+        return self.playlists.setdefault(guild_id, {})
+
+    async def write(self) -> None:
+        # Serialize on the loop so the file never sees a half-applied change
+        data = json.dumps(pack_playlists(self.playlists))
+        async with self.lock:
+            await asyncio.to_thread(settings.write_playlists, data)
+
+    async def append_entries(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        await self.write()
+
+    async def remove_entry(self, guild_id: str, name: str, index: int) -> None:
+        await self.write()
+
+    async def save_playlist(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        await self.write()
+
+    async def delete_playlist(self, guild_id: str, name: str) -> None:
+        await self.write()
+
+    async def rename_playlist(self, guild_id: str, name: str, new_name: str) -> None:
+        await self.write()
+
+    async def apply_changes(self, changes: list[tuple]) -> None:
+        await self.write()
+
+class SqlitePlaylistStore(PlaylistStore):
+    """Keeps playlists in an SQLite database in WAL mode.
+
+    Each track is stored once in the tracks table, playlists hold references to it.
+    Every change is a single transaction touching only the affected rows.
+    Queries run on a dedicated thread so they never block the event loop.
+    """
+
+    def __init__(self, path: os.PathLike) -> None:
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="playlist-store")
+        self.connection: sqlite3.Connection | None = None
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with metrics.span("playlist_db"):
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        with connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS playlists (
+                    guild_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (guild_id, name)
+                );
+                CREATE TABLE IF NOT EXISTS tracks (
+                    key TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id TEXT NOT NULL,
+                    playlist TEXT NOT NULL,
+                    track TEXT NOT NULL REFERENCES tracks (key),
+                    FOREIGN KEY (guild_id, playlist) REFERENCES playlists (guild_id, name) ON DELETE CASCADE
+                );
+                CREATE INDEX IF NOT EXISTS items_by_playlist ON items (guild_id, playlist, id);
+                CREATE INDEX IF NOT EXISTS items_by_track ON items (track);
+            """)
+        return connection
+
+    def _migrate_entries(self, connection: sqlite3.Connection) -> None:
+        """Move entries stored with their full data into the shared tracks table.
+
+        The old table is kept as entries_backup, and the migration is rolled back
+        unless every playlist ends up with the same tracks in the same order.
+        """
+        if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries'").fetchone():
+            return
+
+        rows = connection.execute("SELECT guild_id, playlist, data FROM entries ORDER BY id").fetchall()
+        expected: dict[tuple[str, str], list[str]] = {}
+        with connection:
+            for guild_id, name, data in rows:
+                migrated = track_rows([json.loads(data)])
+                self._insert(connection, guild_id, name, migrated)
+                expected.setdefault((guild_id, name), []).append(migrated[0][0])
+
+            for (guild_id, name), keys in expected.items():
+                stored = [key for (key,) in connection.execute(
+                    "SELECT track FROM items WHERE guild_id = ? AND playlist = ? ORDER BY id", (guild_id, name)
+                )]
+                if stored != keys:
+                    # Leaving the with block rolls the migration back
+                    raise sqlite3.IntegrityError(f"Migrated playlist {name} of guild {guild_id} doesn't match its entries")
+            # A plain copy, so deleting or renaming playlists later doesn't cascade into it
+            connection.execute("CREATE TABLE entries_backup AS SELECT * FROM entries")
+            connection.execute("DROP TABLE entries")
+        logger.info(f"Moved {len(rows)} playlist entries into the shared tracks table, the old ones are kept in entries_backup")
+
+    def _collect_tracks(self, connection: sqlite3.Connection) -> None:
+        """Delete tracks no playlist refers to anymore."""
+        with connection:
+            deleted = connection.execute(
+                "DELETE FROM tracks WHERE NOT EXISTS (SELECT 1 FROM items WHERE items.track = tracks.key)"
+            ).rowcount
+        if deleted:
+            logger.info(f"Deleted {deleted} tracks no playlist refers to")
+
+    def _migrate_json(self, connection: sqlite3.Connection) -> None:
+        """Import playlists.json once, the first time the database is opened."""
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+
+        playlists = unpack_playlists(settings.load_playlists())
+        with connection:
+            for guild_id, guild_playlists in playlists.items():
+                for name, entries in guild_playlists.items():
+                    self._insert(connection, guild_id, name, track_rows(entries))
+            connection.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+
+        if playlists:
+            logger.info(f"Migrated playlists of {len(playlists)} guilds from {settings.PLAYLISTS_PATH}")
+
+    def _open(self) -> None:
+        self.connection = self._connect()
+        self._migrate_entries(self.connection)
+        self._migrate_json(self.connection)
+        self._collect_tracks(self.connection)
+
+    def _load_guild(self, guild_id: str) -> tuple[list[str], list[tuple[str, str, str]]]:
+        names = [name for (name,) in self.connection.execute("SELECT name FROM playlists WHERE guild_id = ?", (guild_id,))]
+        items = self.connection.execute(
+            """SELECT items.playlist, tracks.key, tracks.data FROM items
+            JOIN tracks ON tracks.key = items.track
+            WHERE items.guild_id = ? ORDER BY items.id""",
+            (guild_id,)
+        ).fetchall()
+        return names, items
+
+    def _insert(self, connection: sqlite3.Connection, guild_id: str, name: str, rows: list[tuple[str, str]]) -> None:
+        connection.execute("INSERT OR IGNORE INTO playlists (guild_id, name) VALUES (?, ?)", (guild_id, name))
+        # Newer data of a track replaces the stored one, e.g. once a legacy entry got its encoded track,
+        # but a legacy entry never replaces a track that has one
+        connection.executemany(
+            """INSERT INTO tracks (key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data
+            WHERE json_extract(excluded.data, '$.encoded') IS NOT NULL OR json_extract(tracks.data, '$.encoded') IS NULL""",
+            dict(rows).items()
+        )
+        connection.executemany(
+            "INSERT INTO items (guild_id, playlist, track) VALUES (?, ?, ?)",
+            [(guild_id, name, key) for key, _ in rows]
+        )
+
+    # The statements of each change, run by _apply inside its transaction
+
+    def _append(self, guild_id: str, name: str, rows: list[tuple[str, str]]) -> None:
+        self._insert(self.connection, guild_id, name, rows)
+
+    def _remove(self, guild_id: str, name: str, index: int) -> None:
+        self.connection.execute(
+            """DELETE FROM items WHERE id = (
+                SELECT id FROM items WHERE guild_id = ? AND playlist = ? ORDER BY id LIMIT 1 OFFSET ?
+            )""",
+            (guild_id, name, index)
+        )
+
+    def _replace(self, guild_id: str, name: str, rows: list[tuple[str, str]]) -> None:
+        self.connection.execute("DELETE FROM items WHERE guild_id = ? AND playlist = ?", (guild_id, name))
+        self._insert(self.connection, guild_id, name, rows)
+
+    def _delete(self, guild_id: str, name: str) -> None:
+        self.connection.execute("DELETE FROM playlists WHERE guild_id = ? AND name = ?", (guild_id, name))
+
+    def _rename(self, guild_id: str, name: str, new_name: str) -> None:
+        self.connection.execute("INSERT INTO playlists (guild_id, name) VALUES (?, ?)", (guild_id, new_name))
+        self.connection.execute(
+            "UPDATE items SET playlist = ? WHERE guild_id = ? AND playlist = ?", (new_name, guild_id, name)
+        )
+        self.connection.execute("DELETE FROM playlists WHERE guild_id = ? AND name = ?", (guild_id, name))
+
+    def _apply(self, changes: list[tuple]) -> None:
+        """Run changes as a single transaction."""
+        with self.connection:
+            for statements, *args in changes:
+                statements(*args)
+
+    def _statements(self, method: str, guild_id: str, name: str, *args) -> tuple:
+        """The statements and arguments of a change, with its entries serialized."""
+        if method == "append_entries":
+            return self._append, guild_id, name, track_rows(args[0])
+        if method == "save_playlist":
+            return self._replace, guild_id, name, track_rows(args[0])
+        if method == "remove_entry":
+            return self._remove, guild_id, name, *args
+        if method == "delete_playlist":
+            return self._delete, guild_id, name
+        if method == "rename_playlist":
+            return self._rename, guild_id, name, *args
+        raise ValueError(f"Unknown playlist change: {method}")
+
+    async def open(self) -> None:
+        await self.run(self._open)
+
+    async def load_guild(self, guild_id: str) -> dict:
+        names, items = await self.run(self._load_guild, guild_id)
+        playlists: dict = {name: [] for name in names}
+        for name, key, data in items:
+            # Tracks already loaded by another guild aren't parsed again
+            entry = track_table.get(key)
+            playlists[name].append(entry if entry is not None else track_table.intern(json.loads(data), key))
+        return playlists
+
+    async def append_entries(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        await self.apply_changes([("append_entries", guild_id, name, entries)])
+
+    async def remove_entry(self, guild_id: str, name: str, index: int) -> None:
+        await self.apply_changes([("remove_entry", guild_id, name, index)])
+
+    async def save_playlist(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        await self.apply_changes([("save_playlist", guild_id, name, entries)])
+
+    async def delete_playlist(self, guild_id: str, name: str) -> None:
+        await self.apply_changes([("delete_playlist", guild_id, name)])
+
+    async def rename_playlist(self, guild_id: str, name: str, new_name: str) -> None:
+        await self.apply_changes([("rename_playlist", guild_id, name, new_name)])
+
+    async def apply_changes(self, changes: list[tuple]) -> None:
+        # Only the entries a change added are serialized, whole playlists only when they were replaced
+        await self.run(self._apply, [self._statements(*change) for change in changes])
+
+    async def close(self) -> None:
+        if self.connection:
+            await self.run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown(wait=True)
+
+class WriteBehindStore(PlaylistStore):
+    """Batches playlist changes in front of another store.
+
+    Changes are recorded as they happen and handed to the backend together every
+    `interval` seconds and on close, so a burst of edits costs a single write
+    that only touches what changed.
+    """
+
+    def __init__(self, backend: PlaylistStore, interval: float) -> None:
+        self.backend = backend
+        self.interval = interval
+        # Pending changes in the order they were made, see PlaylistStore.apply_changes
+        self.pending: list[tuple] = []
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+        # Write left running by a cancelled flush, the backend commits it regardless
+        self.writing: asyncio.Task | None = None
+
+    async def open(self) -> None:
+        await self.backend.open()
+        self.task = asyncio.create_task(self.flush_periodically())
+
+    async def load_guild(self, guild_id: str) -> dict:
+        return await self.backend.load_guild(guild_id)
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to save playlists, retrying on the next flush")
+
+    async def flush(self) -> None:
+        """Write every pending change to the backend.
+
+        Cancelling a flush doesn't cancel its write, the next flush waits for it
+        instead of writing the same changes twice.
+        """
+        async with self.lock:
+            await self.wait_for_write()
+            if not self.pending:
+                return
+
+            changes, self.pending = self.pending, []
+            self.writing = asyncio.create_task(self.write(changes))
+            try:
+                await asyncio.shield(self.writing)
+            except Exception:
+                self.writing = None
+                raise
+            # Left set when cancelled, for the next flush to wait on
+            self.writing = None
+
+    async def write(self, changes: list[tuple]) -> None:
+        try:
+            with metrics.span("playlist_flush"):
+                await self.backend.apply_changes(changes)
+        except Exception:
+            # Nothing was committed, changes made meanwhile come after the ones that failed
+            self.pending[:0] = changes
+            raise
+
+    async def wait_for_write(self) -> None:
+        if self.writing is None:
+            return
+        await asyncio.wait([self.writing])
+        if not self.writing.cancelled() and self.writing.exception():
+            logger.error(f"Failed to save playlists, retrying: {self.writing.exception()!r}")
+        self.writing = None
+
+    async def append_entries(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        self.pending.append(("append_entries", guild_id, name, list(entries)))
+
+    async def remove_entry(self, guild_id: str, name: str, index: int) -> None:
+        self.pending.append(("remove_entry", guild_id, name, index))
+
+    async def save_playlist(self, guild_id: str, name: str, entries: list[dict]) -> None:
+        # The entries as they are now, later changes are replayed on top of them
+        self.pending.append(("save_playlist", guild_id, name, list(entries)))
+
+    async def delete_playlist(self, guild_id: str, name: str) -> None:
+        self.pending.append(("delete_playlist", guild_id, name))
+
+    async def rename_playlist(self, guild_id: str, name: str, new_name: str) -> None:
+        self.pending.append(("rename_playlist", guild_id, name, new_name))
+
+    async def apply_changes(self, changes: list[tuple]) -> None:
+        self.pending.extend(changes)
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        try:
+            await self.flush()
+        finally:
+            await self.backend.close()
+
+def create_playlist_store() -> PlaylistStore:
+    """Create the playlist store selected by the PLAYLIST_STORE and PLAYLIST_FLUSH_INTERVAL settings."""
+    if settings.PLAYLIST_STORE == "json":
+        store = JsonPlaylistStore()
+    elif settings.PLAYLIST_STORE == "sqlite":
+        store = SqlitePlaylistStore(settings.PLAYLISTS_DB_PATH)
+    else:
+        raise ValueError(f"Unknown playlist store: {settings.PLAYLIST_STORE}")
+
+    if settings.PLAYLIST_FLUSH_INTERVAL > 0:
+        store = WriteBehindStore(store, settings.PLAYLIST_FLUSH_INTERVAL)
+    return store
@@ -0,0 +1,131 @@
+import asyncio
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator
+
+import settings
+from utils.cache import SearchCache
+from utils.circuit import lavalink
+from utils.metrics import metrics
+
+import wavelink
+
+logger = settings.logging.getLogger(__name__)
+
+async def fetch_tracks(query: str, source: wavelink.TrackSource | None) -> wavelink.Search:
+    # Only cache misses get here
+    with metrics.span("lavalink_search"):
+        return await lavalink.search(query, source)
+
+# Shared by every guild, results don't depend on who asked
+search_cache = SearchCache(
+    fetch_tracks,
+    capacity=settings.SEARCH_CACHE_SIZE,
+    ttl=settings.SEARCH_CACHE_TTL,
+    negative_ttl=settings.SEARCH_CACHE_NEGATIVE_TTL
+)
+
+async def search_tracks(query: str) -> wavelink.Search:
+    """Search for tracks through the search cache, using Spotify for Spotify links and YouTube otherwise."""
+    if "open.spotify.com" in query:
+        return await search_cache.get(query)
+    return await search_cache.get(query, wavelink.TrackSource.YouTube)
+
+def track_to_entry(track: wavelink.Playable) -> dict:
+    """Serialize a track into a playlist entry that can be rebuilt without searching."""
+    return {
+        "title": track.title,
+        "url": track.uri,
+        "encoded": track.encoded,
+        "info": {
+            "identifier": track.identifier,
+            "isSeekable": track.is_seekable,
+            "author": track.author,
+            "length": track.length,
+            "isStream": track.is_stream,
+            "position": track.position,
+            "title": track.title,
+            "uri": track.uri,
+            "artworkUrl": track.artwork,
+            "isrc": track.isrc,
+            "sourceName": track.source
+        },
+        "pluginInfo": {
+            "albumName": track.album.name,
+            "albumUrl": track.album.url,
+            "artistUrl": track.artist.url,
+            "artistArtworkUrl": track.artist.artwork,
+            "previewUrl": track.preview_url,
+            "isPreview": track.is_preview
+        }
+    }
+
+def display_info(track: wavelink.Playable) -> dict:
+    """Title, author, artwork and url to show for a track, keeping the original ones of prefetched mirrors."""
+    extras = dict(track.extras)
+    return {
+        "title": extras.get("title", track.title),
+        "author": extras.get("author", track.author),
+        "artwork": extras.get("artwork", track.artwork),
+        "uri": extras.get("uri", track.uri)
+    }
+
+def entry_to_track(entry: dict) -> wavelink.Playable | None:
+    """Rebuild a track from its stored encoded data. Returns None for entries saved before encoding was stored."""
+    if "encoded" not in entry or "info" not in entry:
+        return None
+
+    return wavelink.Playable({
+        "encoded": entry["encoded"],
+        "info": entry["info"],
+        "pluginInfo": entry.get("pluginInfo", {}),
+        "userData": entry.get("userData", {})
+    })
+
+async def resolve_entry(entry: dict) -> wavelink.Playable | None:
+    """Resolve a playlist entry into a track.
+
+    Entries with stored encoded data are rebuilt locally. Older entries that only
+    have a url are searched and upgraded in place so the next load doesn't need to search them again.
+    Raises LavalinkUnavailable when Lavalink can't be searched, rather than reporting the song missing.
+    """
+    track = entry_to_track(entry)
+    if track:
+        return track
+
+    try:
+        tracks: wavelink.Search = await search_tracks(entry["url"])
+    except wavelink.LavalinkLoadException as e:
+        logger.warning(f"Could not load playlist entry {entry['url']}: {e}")
+        return None
+
+    if not tracks:
+        return None
+
+    track = tracks[0]
+    stored = track_to_entry(track)
+    entry["encoded"] = stored["encoded"]
+    entry["info"] = stored["info"]
+    entry["pluginInfo"] = stored["pluginInfo"]
+    return track
+
+async def stream_entries(entries: list[dict], concurrency: int) -> AsyncIterator[wavelink.Playable | None]:
+    """Resolve playlist entries with at most `concurrency` searches in flight, yielding tracks in playlist order.
+
+    Yields None for entries that could not be found. Closing the generator cancels the searches still in flight.
+    """
+    remaining = iter(entries)
+    pending: deque[asyncio.Task] = deque()
+
+    for entry in islice(remaining, concurrency):
+        pending.append(asyncio.create_task(resolve_entry(entry)))
+
+    try:
+        while pending:
+            track = await pending.popleft()
+            for entry in islice(remaining, 1):
+                pending.append(asyncio.create_task(resolve_entry(entry)))
+            yield track
+    finally:
+        for task in pending:
+            task.cancel()